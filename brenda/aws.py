@@ -19,10 +19,12 @@ from __future__ import print_function
 from future import standard_library
 standard_library.install_aliases()
 from builtins import str
+from builtins import range
 from past.utils import old_div
-import os, time, datetime, calendar, urllib.request, urllib.error, urllib.parse
-import boto3
-from brenda import utils
+import os, io, time, datetime, calendar, threading, urllib.request, urllib.error, urllib.parse
+import concurrent.futures
+import boto3, boto3.s3.transfer, botocore.config, botocore.exceptions
+from brenda import utils, error
 from brenda.error import ValueErrorRetry
 from brenda.ami import AMI_ID
 
@@ -32,14 +34,24 @@ def aws_creds(conf):
         'aws_secret_access_key' : conf['AWS_SECRET_KEY'],
         }
 
+def aws_endpoint(conf, resource_type):
+    """
+    Optional endpoint override, e.g. SQS_ENDPOINT=http://localhost:5000,
+    to use a local stand-in for an AWS service.
+    """
+    endpoint = conf.get(resource_type.upper() + '_ENDPOINT')
+    if endpoint:
+        return {'endpoint_url' : endpoint}
+    return {}
+
 def get_conn(conf, resource_type="s3"):
     region = conf.get('S3_REGION')
     if region:
-        conn = boto3.resource(resource_type, region_name=region, **aws_creds(conf))
+        conn = boto3.resource(resource_type, region_name=region, **dict(aws_creds(conf), **aws_endpoint(conf, resource_type)))
         if not conn:
             raise ValueErrorRetry("Could not establish {} connection to region {}".format(resource_type, region))
     else:
-        conn = boto3.resource(resource_type, **aws_creds(conf))
+        conn = boto3.resource(resource_type, **dict(aws_creds(conf), **aws_endpoint(conf, resource_type)))
     return conn
 
 def get_ec2_client(conf):
@@ -53,53 +65,312 @@ def get_ec2_client(conf):
         conn = boto3.client(resource_type, **aws_creds(conf))
     return conn
 
+# boto3 clients are thread-safe but must not be shared across
+# processes, so cache them per process ID
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_s3_client(conf):
+    """
+    Return an S3 client that is shared by all threads of this
+    process, so that connections are reused across uploads.
+    """
+    key = (os.getpid(), 's3')
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            kw = dict(aws_creds(conf), **aws_endpoint(conf, 's3'))
+            region = conf.get('S3_REGION')
+            if region:
+                kw['region_name'] = region
+            client = boto3.client('s3', config=botocore.config.Config(
+                max_pool_connections=max(10, s3_upload_threads(conf) * s3_transfer_config(conf).max_request_concurrency,
+                                         int(conf.get('CURL_MAX_THREADS', '16')))), **kw)
+            _clients[key] = client
+        return client
+
+def get_sqs_client(conf, max_pool_connections=10):
+    """
+    Return an SQS client that is shared by all threads of this
+    process.  Unlike the boto3 resource returned by get_conn, it
+    may be used by several threads at once.
+    """
+    key = (os.getpid(), 'sqs')
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            kw = dict(aws_creds(conf), **aws_endpoint(conf, 'sqs'))
+            region = conf.get('S3_REGION')
+            if region:
+                kw['region_name'] = region
+            client = boto3.client('sqs', config=botocore.config.Config(
+                max_pool_connections=max_pool_connections), **kw)
+            _clients[key] = client
+        return client
+
+def s3_upload_threads(conf):
+    return int(conf.get('S3_UPLOAD_THREADS', '4'))
+
+def s3_transfer_config(conf):
+    """
+    Transfer config for S3 uploads.  Files larger than
+    S3_MULTIPART_THRESHOLD (in MB) are uploaded in parts of
+    S3_MULTIPART_CHUNKSIZE MB, S3_MULTIPART_CONCURRENCY at a time.
+    """
+    mb = 1024 * 1024
+    return boto3.s3.transfer.TransferConfig(
+        multipart_threshold=int(float(conf.get('S3_MULTIPART_THRESHOLD', '64')) * mb),
+        multipart_chunksize=int(float(conf.get('S3_MULTIPART_CHUNKSIZE', '16')) * mb),
+        max_concurrency=int(conf.get('S3_MULTIPART_CONCURRENCY', '4')))
+
 def parse_s3_url(url):
     if url.startswith('s3://'):
         return url[5:].split('/', 1)
 
+class S3Object(object):
+    """
+    An S3 object (given as s3://BUCKET/FILE) opened for ranged
+    reads.  If etag from previous download is provided, and the
+    object hasn't changed since then, raise error.ETagMatch.
+    All reads are made with If-Match against the ETag seen when
+    the object was opened, so that a read never mixes two
+    versions of the object.
+    """
+
+    def __init__(self, conf, s3url, etag=None):
+        self.s3url = s3url
+        self.n_retries = int(conf.get('CURL_N_RETRIES', '4'))
+        self.debug = int(conf.get('CURL_DEBUG', '1'))
+        self.chunk_size = int(float(conf.get('CURL_CHUNK_SIZE', '16')) * 1048576)
+        s3tup = parse_s3_url(s3url)
+        if not s3tup or len(s3tup) != 2:
+            raise ValueError("s3_get: bad s3 url: %r" % (s3url,))
+        self.bucket, self.key = s3tup
+        self.client = get_s3_client(conf)
+
+        # conditional fetch
+        head_kw = {}
+        if etag:
+            head_kw['IfNoneMatch'] = etag
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key, **head_kw)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+                raise error.ETagMatch(etag)
+            raise
+        self.etag = head['ETag']
+        self.content_len = head['ContentLength']
+
+    def ranges(self):
+        # split the object into chunk_size ranges
+        return [(i, min(i + self.chunk_size, self.content_len)) for i in range(0, self.content_len, self.chunk_size)]
+
+    def get_range(self, start, end, write):
+        """
+        Get bytes start..end-1, calling write(pos, data) for each
+        block of data received.  On error, the range is retried
+        after the last byte written, up to CURL_N_RETRIES times.
+        """
+        pos = start
+        for i in range(self.n_retries + 1):
+            try:
+                resp = self.client.get_object(Bucket=self.bucket, Key=self.key, IfMatch=self.etag,
+                                              Range="bytes=%d-%d" % (pos, end - 1))
+                body = resp['Body']
+                while pos < end:
+                    data = body.read(min(1048576, end - pos))
+                    if not data:
+                        raise IOError("s3_get: short read at byte %d of %s" % (pos, self.s3url))
+                    write(pos, data)
+                    pos += len(data)
+                return
+            except Exception as e:
+                # the object changed under us, so there is no point in retrying
+                if isinstance(e, botocore.exceptions.ClientError) and \
+                        e.response.get('Error', {}).get('Code') in ('412', 'PreconditionFailed'):
+                    raise
+                if i >= self.n_retries:
+                    raise
+                if self.debug >= 1:
+                    print("s3_get: retry %d/%d of bytes %d-%d of %s: %s" % (
+                        i + 1, self.n_retries, pos, end - 1, self.s3url, e))
+                time.sleep(min(2 ** i, 30))
+
+    def read_range(self, start, end):
+        buf = bytearray(end - start)
+        def write(pos, data):
+            buf[pos-start:pos-start+len(data)] = data
+        self.get_range(start, end, write)
+        return bytes(buf)
+
+    def report(self, start_time, n_ranges):
+        if self.debug >= 1:
+            elapsed = max(time.time() - start_time, 0.001)
+            print("s3_get: %s: %d bytes in %.2f seconds (%.2f MB/s, %d ranges)" % (
+                self.s3url, self.content_len, elapsed, self.content_len / elapsed / 1048576, n_ranges))
+
+class S3RangeFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over an S3Object, for readers
+    such as zipfile that need random access.  Each read past the
+    buffer fetches at least CURL_CHUNK_SIZE bytes with a ranged GET.
+    """
+
+    def __init__(self, obj):
+        io.RawIOBase.__init__(self)
+        self.obj = obj
+        self.pos = 0
+        self.buf = b''
+        self.buf_start = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.obj.content_len
+        self.pos = max(0, offset)
+        return self.pos
+
+    def readinto(self, b):
+        n = min(len(b), self.obj.content_len - self.pos)
+        if n <= 0:
+            return 0
+        if not (self.buf_start <= self.pos and self.pos + n <= self.buf_start + len(self.buf)):
+            end = min(self.pos + max(n, self.obj.chunk_size), self.obj.content_len)
+            self.buf = self.obj.read_range(self.pos, end)
+            self.buf_start = self.pos
+        off = self.pos - self.buf_start
+        b[:n] = self.buf[off:off+n]
+        self.pos += n
+        return n
+
 def s3_get(conf, s3url, dest, etag=None):
     """
-    High-speed download from S3 that can use multiple simultaneous
-    download threads to optimize the downloading of a single file.
+    High-speed download from S3 that uses up to CURL_MAX_THREADS
+    simultaneous ranged GETs of CURL_CHUNK_SIZE MB each to download
+    a single file.  Each range is written to its place in dest as it
+    arrives, so memory use doesn't depend on the file size, and is
+    retried on its own (up to CURL_N_RETRIES times) if it fails.
     S3 file is given in s3url (using s3://BUCKET/FILE naming
     convention) and will be saved in dest.  If etag from previous
     download is provided, and file hasn't changed since then, don't
-    download the file and instead raise an exception of type
-    paracurl.Exception where the first element of the exception
-    tuple == paracurl.PC_ERR_ETAG_MATCH.  Returns tuple of
-    (file_length, etag).
+    download the file and instead raise error.ETagMatch.  Returns
+    tuple of (file_length, etag).
     """
-
-    paracurl_kw = {
-        'max_threads' : int(conf.get('CURL_MAX_THREADS', '16')),
-        'n_retries' : int(conf.get('CURL_N_RETRIES', '4')),
-        'debug' : int(conf.get('CURL_DEBUG', '1'))
-        }
-    if etag:
-        paracurl_kw['etag'] = etag
-    s3tup = parse_s3_url(s3url)
-    if not s3tup or len(s3tup) != 2:
-        raise ValueError("s3_get: bad s3 url: %r" % (s3url,))
-    conn = get_conn(conf, "s3")
-    buck = conn.Bucket(s3tup[0])
-    object_ref = conn.Object(buck.name,s3tup[1])
-    key = object_ref.get()
-    etag = key['ETag']
-    content_len = key['ContentLength']
-    body = key['Body'].read()
-    with open(dest, 'wb') as file_out:
-        file_out.write(body)
-    return content_len, etag
+    max_threads = int(conf.get('CURL_MAX_THREADS', '16'))
+    obj = S3Object(conf, s3url, etag)
+
+    start_time = time.time()
+    ranges = obj.ranges()
+    fd = os.open(dest, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o644)
+    write = lambda pos, data: os.pwrite(fd, data, pos)
+    try:
+        os.ftruncate(fd, obj.content_len)
+        if len(ranges) <= 1 or max_threads <= 1:
+            for start, end in ranges:
+                obj.get_range(start, end, write)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_threads, len(ranges))) as pool:
+                for f in [pool.submit(obj.get_range, start, end, write) for start, end in ranges]:
+                    f.result()
+    finally:
+        os.close(fd)
+    obj.report(start_time, len(ranges))
+    return obj.content_len, obj.etag
+
+def s3_get_stream(conf, obj, write):
+    """
+    Like s3_get, but rather than save the S3Object obj, pass its
+    content in order to write(data), for example to feed an
+    extractor while the download is still running.  Ranges are
+    fetched in parallel, so up to CURL_MAX_THREADS * CURL_CHUNK_SIZE
+    MB are held in memory.  Returns tuple of (file_length, etag).
+    """
+    max_threads = max(1, int(conf.get('CURL_MAX_THREADS', '16')))
+
+    start_time = time.time()
+    ranges = obj.ranges()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as pool:
+        futures = [pool.submit(obj.read_range, start, end) for start, end in ranges[:max_threads]]
+        for i in range(len(ranges)):
+            data = futures[i].result()
+            futures[i] = None
+            if i + max_threads < len(ranges):
+                futures.append(pool.submit(obj.read_range, *ranges[i + max_threads]))
+            write(data)
+    obj.report(start_time, len(ranges))
+    return obj.content_len, obj.etag
+
+# characters at which key ranges are split for parallel listing
+S3_LIST_SPLIT_CHARS = '-.0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+def s3_list_keys(conf, bucket, prefix=''):
+    """
+    Return the keys of all objects in bucket that start with
+    prefix, listing up to S3_LIST_THREADS pages at once.  The
+    keyspace is split into ranges as it is discovered: after
+    each full page, the rest of a range is divided at the
+    characters following (most of) the prefix that the keys on
+    the page have in common, and each part is listed on its own.
+    A range (start, end] is listed with StartAfter=start, and
+    keys beyond end are left to the next range, so each key is
+    returned exactly once.
+    """
+    max_threads = max(1, int(conf.get('S3_LIST_THREADS', '16')))
+    client = get_s3_client(conf)
+
+    def list_range(start, end):
+        kw = dict(Bucket=bucket, Prefix=prefix)
+        if start is not None:
+            kw['StartAfter'] = start
+        resp = client.list_objects_v2(**kw)
+        page = [o['Key'] for o in resp.get('Contents', [])]
+        keys = [k for k in page if end is None or k <= end]
+        if not resp.get('IsTruncated') or len(keys) < len(page):
+            return keys, []
+
+        # split the rest of the range
+        last = page[-1]
+        common = os.path.commonprefix([page[0], last])
+        common = common[:max(len(prefix), len(common) - 2)]
+        points = [last]
+        for c in S3_LIST_SPLIT_CHARS:
+            b = common + c
+            if b > points[-1] and (end is None or b < end):
+                points.append(b)
+        points.append(end)
+        return keys, list(zip(points[:-1], points[1:]))
+
+    keys = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as pool:
+        futures = set([pool.submit(list_range, None, None)])
+        while futures:
+            done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                k, ranges = f.result()
+                keys.extend(k)
+                for r in ranges:
+                    futures.add(pool.submit(list_range, *r))
+    return keys
 
 def put_s3_file(conf, bucktup, path, s3name):
     """
     bucktup is the return tuple of get_s3_output_bucket_name
     """
 
-    conn = get_conn(conf, "s3")
-
-    object_ref = conn.Object(bucktup[1][0],bucktup[1][1] + s3name)
-    object_ref.put(Body=open(path, 'rb'), StorageClass='REDUCED_REDUNDANCY')
+    client = get_s3_client(conf)
+    client.upload_file(path, bucktup[1][0], bucktup[1][1] + s3name,
+                       ExtraArgs={'StorageClass' : 'REDUCED_REDUNDANCY'},
+                       Config=s3_transfer_config(conf))
 
 
 def format_s3_url(bucktup, s3name):
@@ -157,6 +428,97 @@ def get_sqs_queue(conf):
 def write_sqs_queue(string, queue):
     queue.send_message(MessageBody=string)
 
+# max number of entries in an SQS batch request
+SQS_BATCH_MAX = 10
+
+def sqs_batches(items):
+    for i in range(0, len(items), SQS_BATCH_MAX):
+        yield items[i:i+SQS_BATCH_MAX]
+
+# max total size of the messages in an SQS batch request
+SQS_BATCH_MAX_BYTES = 262144
+
+def sqs_message_batches(bodies):
+    """
+    Group an iterable of message bodies into lists that
+    SendMessageBatch accepts: at most SQS_BATCH_MAX messages
+    of at most SQS_BATCH_MAX_BYTES in total.
+    """
+    batch = []
+    size = 0
+    for body in bodies:
+        n = len(body.encode('utf-8'))
+        if batch and (len(batch) >= SQS_BATCH_MAX or size + n > SQS_BATCH_MAX_BYTES):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(body)
+        size += n
+    if batch:
+        yield batch
+
+def send_sqs_batch(client, queue_url, bodies, n_retries=5):
+    """
+    Send bodies (one batch from sqs_message_batches) with
+    SendMessageBatch, resending the entries that fail on the
+    SQS side up to n_retries times.  Returns the number of SQS
+    calls made.
+    """
+    entries = dict((str(i), body) for i, body in enumerate(bodies))
+    calls = 0
+    for i in range(n_retries + 1):
+        resp = client.send_message_batch(QueueUrl=queue_url, Entries=[
+            {'Id': id, 'MessageBody': body} for id, body in entries.items()])
+        calls += 1
+        failed = resp.get('Failed', [])
+        if not failed:
+            return calls
+        for f in failed:
+            if f.get('SenderFault'):
+                raise ValueError("SQS rejected message: %s" % (f.get('Message', f.get('Code')),))
+        entries = dict((f['Id'], entries[f['Id']]) for f in failed)
+        time.sleep(min(0.1 * 2 ** i, 5))
+    raise ValueErrorRetry("SQS send failed for %d messages after %d retries" % (len(entries), n_retries))
+
+def sqs_batch_failures(resp):
+    for f in resp.get('Failed', []):
+        print("SQS batch entry %s failed: %s" % (f.get('Id'), f.get('Message', f.get('Code'))))
+    return len(resp.get('Failed', []))
+
+def change_sqs_visibility(queue, messages, visibility_timeout):
+    """
+    Set the visibility timeout of messages using as few
+    ChangeMessageVisibilityBatch calls as possible.  Returns
+    the number of SQS calls made.
+    """
+    calls = 0
+    for batch in sqs_batches(messages):
+        resp = queue.change_message_visibility_batch(Entries=[
+            {
+                'Id': str(i),
+                'ReceiptHandle': msg.receipt_handle,
+                'VisibilityTimeout': visibility_timeout
+            } for i, msg in enumerate(batch)])
+        sqs_batch_failures(resp)
+        calls += 1
+    return calls
+
+def delete_sqs_messages(queue, messages):
+    """
+    Delete messages from queue using as few DeleteMessageBatch
+    calls as possible.  Returns the number of SQS calls made.
+    """
+    calls = 0
+    for batch in sqs_batches(messages):
+        resp = queue.delete_messages(Entries=[
+            {
+                'Id': str(i),
+                'ReceiptHandle': msg.receipt_handle
+            } for i, msg in enumerate(batch)])
+        sqs_batch_failures(resp)
+        calls += 1
+    return calls
+
 def get_ec2_instances_from_conn(conn, instance_ids=None):
     filter_args = {}
 
@@ -392,6 +754,11 @@ def get_instance_id_self():
     the_page = response.read()
     return the_page
 
+def get_local_ipv4_self():
+    req = urllib.request.Request("http://169.254.169.254/latest/meta-data/local-ipv4")
+    response = urllib.request.urlopen(req, timeout=5)
+    return response.read().decode('utf-8').strip()
+
 def get_spot_request_dict(conf):
     ec2 = get_ec2_client(conf)
     requests = ec2.describe_spot_instance_requests().get('SpotInstanceRequests')
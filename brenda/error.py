@@ -28,6 +28,13 @@ class ValueErrorRetry(ValueError):
     """
     pass
 
+class ETagMatch(Exception):
+    """
+    Raised by aws.s3_get when the S3 object still has the
+    ETag of a previous download, so it wasn't fetched again.
+    """
+    pass
+
 def retry(conf, action):
     n_retries = int(conf.get('N_RETRIES', '5'))
     reset_period = int(conf.get('RESET_PERIOD', '3600'))
@@ -0,0 +1,285 @@
+from __future__ import division
+from __future__ import print_function
+# Brenda -- Blender render tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Manifest projects are an alternative to project bundles, where a
+# changed file doesn't force every node to fetch the whole project
+# again.  A project published to s3://BUCKET/myproject.manifest
+# consists of:
+#
+#   s3://BUCKET/myproject.manifest        -- JSON manifest of the project
+#   s3://BUCKET/myproject.objects/SHA256  -- content of each file, named
+#                                            by its SHA-256 hash
+#
+# The manifest maps the path of each file to its hash, size, mode and
+# mtime, and also lists symlinks and directories.  Publishing uploads
+# only the objects that aren't in S3 yet, then replaces the manifest.
+# A node keeps the manifest it last applied in its project directory
+# (as MANIFEST_FN), fetches only files whose hashes have changed,
+# hard-links the rest from its current copy into a new tree, and
+# swaps the new tree into place.
+
+import os, json, time, random, hashlib
+import concurrent.futures
+from brenda import aws, utils
+
+MANIFEST_VERSION = 1
+
+# name of the manifest in a project directory
+MANIFEST_FN = '.brenda-manifest'
+
+def is_manifest_url(url):
+    return url.startswith('s3://') and url.endswith('.manifest')
+
+def objects_url(s3url):
+    return s3url[:-len('.manifest')] + '.objects/'
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1048576)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def empty_manifest():
+    return dict(version=MANIFEST_VERSION, files={}, links={}, dirs=[])
+
+def read_local(dir):
+    # return the manifest last applied to dir, or an empty manifest
+    try:
+        with open(os.path.join(dir, MANIFEST_FN)) as f:
+            m = json.load(f)
+        if m.get('version') == MANIFEST_VERSION:
+            return m
+    except Exception:
+        pass
+    return empty_manifest()
+
+def write_local(dir, m):
+    utils.write_atomic(os.path.join(dir, MANIFEST_FN), json.dumps(m, sort_keys=True), sync=True)
+
+def scan(dir, cached=None):
+    """
+    Return a manifest for the tree in dir.  Files whose size and
+    mtime match their entry in the cached manifest aren't hashed
+    again.
+    """
+    cached = cached['files'] if cached else {}
+    m = empty_manifest()
+    for dirpath, dirnames, filenames in os.walk(dir):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, dir)
+        for d in list(dirnames):
+            path = os.path.join(dirpath, d)
+            rel = os.path.normpath(os.path.join(rel_dir, d))
+            if os.path.islink(path):
+                m['links'][rel] = os.readlink(path)
+                dirnames.remove(d)
+            else:
+                m['dirs'].append(rel)
+        for f in sorted(filenames):
+            path = os.path.join(dirpath, f)
+            rel = os.path.normpath(os.path.join(rel_dir, f))
+            if rel == MANIFEST_FN:
+                continue
+            if os.path.islink(path):
+                m['links'][rel] = os.readlink(path)
+                continue
+            st = os.stat(path)
+            entry = dict(size=st.st_size, mode=st.st_mode & 0o777, mtime=int(st.st_mtime))
+            c = cached.get(rel)
+            if c and c['size'] == entry['size'] and c['mtime'] == entry['mtime']:
+                entry['hash'] = c['hash']
+            else:
+                entry['hash'] = hash_file(path)
+            m['files'][rel] = entry
+    return m
+
+def get_manifest(conf, s3url):
+    # return the manifest at s3url, or None if it doesn't exist
+    s3tup = aws.parse_s3_url(s3url)
+    client = aws.get_s3_client(conf)
+    try:
+        resp = client.get_object(Bucket=s3tup[0], Key=s3tup[1])
+    except client.exceptions.NoSuchKey:
+        return None
+    return json.loads(resp['Body'].read().decode('utf-8'))
+
+def publish(conf, dir, s3url, dry_run=False):
+    """
+    Publish the tree in dir as a new version of the manifest
+    project at s3url, uploading only the file contents that
+    the current version doesn't already have.
+    """
+    start_time = time.time()
+    m = scan(dir, read_local(dir))
+    old = get_manifest(conf, s3url) or empty_manifest()
+    have = set(e['hash'] for e in old['files'].values())
+
+    # find the new file contents
+    upload = {}
+    for rel, e in m['files'].items():
+        if e['hash'] not in have:
+            upload.setdefault(e['hash'], (rel, e['size']))
+    changed = [rel for rel, e in m['files'].items()
+               if rel not in old['files'] or old['files'][rel]['hash'] != e['hash']]
+    removed = [rel for rel in old['files'] if rel not in m['files']]
+    up_bytes = sum(size for rel, size in upload.values())
+    for rel in sorted(changed):
+        print("CHANGED", rel)
+    for rel in sorted(removed):
+        print("REMOVED", rel)
+
+    if not dry_run:
+        # upload new objects, then the manifest that refers to them
+        client = aws.get_s3_client(conf)
+        bucket, prefix = aws.parse_s3_url(objects_url(s3url))
+        def put(h, rel):
+            print("PUSH", rel, "TO", objects_url(s3url) + h)
+            client.upload_file(os.path.join(dir, rel), bucket, prefix + h,
+                               Config=aws.s3_transfer_config(conf))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=aws.s3_upload_threads(conf)) as pool:
+            for f in [pool.submit(put, h, rel) for h, (rel, size) in upload.items()]:
+                f.result()
+        s3tup = aws.parse_s3_url(s3url)
+        client.put_object(Bucket=s3tup[0], Key=s3tup[1], Body=json.dumps(m, sort_keys=True).encode('utf-8'),
+                          ContentType='application/json')
+        write_local(dir, m)
+
+    print("PUBLISHED %s: %d files, %d changed, %d removed, %d objects (%.2f MB) uploaded in %.2f seconds" % (
+        s3url, len(m['files']), len(changed), len(removed), len(upload), up_bytes / 1048576.0,
+        time.time() - start_time))
+    return m
+
+def sync(conf, s3url, proj_dir, refetch=False, server=None, fetcher=None):
+    """
+    Bring proj_dir up to date with the manifest project at s3url.
+    Files that haven't changed are hard-linked from the current
+    proj_dir into a new tree, the others are fetched from S3 and
+    verified, then the new tree replaces proj_dir.  With refetch
+    set, all files are fetched.  If a peer.PeerFetcher is given,
+    files are fetched from peers when possible, and objects we
+    have are served to peers by the peer.PeerServer server.
+    """
+    start_time = time.time()
+    m = get_manifest(conf, s3url)
+    if m is None:
+        raise ValueError("%s: manifest not found" % (s3url,))
+    if m.get('version') != MANIFEST_VERSION:
+        raise ValueError("%s: unsupported manifest version %r" % (s3url, m.get('version')))
+    cur = empty_manifest() if refetch else read_local(proj_dir)
+    if cur == m:
+        print("Project %s is unchanged, using %s" % (s3url, proj_dir))
+        if server is not None:
+            server.set_objects((e['hash'], os.path.join(proj_dir, rel)) for rel, e in m['files'].items())
+        return
+
+    # index the files we have by hash, checking that they
+    # still match what the manifest says about them
+    have = {}
+    for rel, e in cur['files'].items():
+        path = os.path.join(proj_dir, rel)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if st.st_size == e['size'] and int(st.st_mtime) == e['mtime']:
+            have.setdefault(e['hash'], path)
+    if server is not None:
+        server.set_objects(have)
+
+    new_dir = proj_dir + '.pre.tmp'
+    old_dir = proj_dir + '.old.tmp'
+    utils.rmtree(new_dir)
+    utils.rmtree(old_dir)
+    utils.makedirs(new_dir)
+    try:
+        for rel in m['dirs']:
+            os.makedirs(os.path.join(new_dir, rel))
+
+        fetch = {}
+        for rel, e in sorted(m['files'].items()):
+            path = os.path.join(new_dir, rel)
+            if e['hash'] in have:
+                os.link(have[e['hash']], path)
+            elif e['hash'] in fetch:
+                fetch[e['hash']][1].append(path)
+            else:
+                fetch[e['hash']] = (e, [path])
+
+        # fetch the changed files, several small ones at a time,
+        # large ones with parallel ranged GETs
+        def get(h, e, paths):
+            if fetcher is None or not fetcher.fetch(h, paths[0]):
+                s3url_obj = objects_url(s3url) + h
+                if e['size'] > chunk_size:
+                    aws.s3_get(conf, s3url_obj, paths[0])
+                else:
+                    obj = aws.S3Object(conf, s3url_obj)
+                    with open(paths[0], 'wb') as f:
+                        f.write(obj.read_range(0, obj.content_len))
+                if hash_file(paths[0]) != h:
+                    raise ValueError("%s: hash mismatch" % (s3url_obj,))
+            if server is not None:
+                server.add(h, paths[0])
+            for p in paths[1:]:
+                os.link(paths[0], p)
+        chunk_size = int(float(conf.get('CURL_CHUNK_SIZE', '16')) * 1048576)
+        small = [(h, e, paths) for h, (e, paths) in fetch.items() if e['size'] <= chunk_size]
+        large = [(h, e, paths) for h, (e, paths) in fetch.items() if e['size'] > chunk_size]
+        if fetcher is not None:
+            # nodes that boot together fetch in different orders,
+            # so that they soon have objects to share
+            random.shuffle(small)
+            random.shuffle(large)
+        max_threads = max(1, int(conf.get('CURL_MAX_THREADS', '16')))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as pool:
+            for f in [pool.submit(get, *a) for a in small]:
+                f.result()
+        for a in large:
+            get(*a)
+
+        # files get the mode and mtime of the manifest, so
+        # that they can be checked cheaply next time
+        for rel, e in m['files'].items():
+            path = os.path.join(new_dir, rel)
+            os.chmod(path, e['mode'])
+            os.utime(path, (e['mtime'], e['mtime']))
+        for rel, target in m['links'].items():
+            os.symlink(target, os.path.join(new_dir, rel))
+        write_local(new_dir, m)
+
+        # swap in the new tree
+        if os.path.exists(proj_dir):
+            os.rename(proj_dir, old_dir)
+        os.rename(new_dir, proj_dir)
+        if server is not None:
+            server.set_objects((e['hash'], os.path.join(proj_dir, rel)) for rel, e in m['files'].items())
+    finally:
+        utils.rmtree(new_dir)
+        utils.rmtree(old_dir)
+
+    print("SYNCED %s: %d files, %d fetched (%.2f MB), %d reused in %.2f seconds" % (
+        s3url, len(m['files']), sum(len(paths) for e, paths in fetch.values()),
+        sum(e['size'] for e, paths in fetch.values()) / 1048576.0,
+        len(m['files']) - sum(len(paths) for e, paths in fetch.values()),
+        time.time() - start_time))
+    if fetcher is not None:
+        print("SYNCED from peers: %d objects (%.2f MB)" % (fetcher.fetched, fetcher.bytes / 1048576.0))
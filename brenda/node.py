@@ -16,52 +16,87 @@ from __future__ import print_function
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from builtins import object
-import os, sys, signal, subprocess, multiprocessing, stat, time
-from brenda import aws, utils, error
+from builtins import range
+import os, sys, signal, subprocess, multiprocessing, multiprocessing.connection, stat, time, zipfile, atexit
+import concurrent.futures
+from brenda import aws, utils, error, upload, spool, manifest, peer, template, tiling
 
 class State(object):
     pass
 
-# We use subprocess.Popen (for blender task) and
-# multiprocessing.Process (for S3-push task) polymorphically,
-# so add some methods to make them consistent.
+# Subprocess (for blender task) exposes a sentinel file
+# descriptor that becomes readable when the process exits
+# (None if the platform can't provide one), like the
+# sentinel of multiprocessing.Process.
 
 class Subprocess(subprocess.Popen):
-    def stop(self):
-        self.terminate()
-        return self.wait()
+    def __init__(self, *args, **kwargs):
+        subprocess.Popen.__init__(self, *args, **kwargs)
+        try:
+            self.sentinel = os.pidfd_open(self.pid)
+        except (AttributeError, OSError):
+            self.sentinel = None
 
-class Multiprocess(multiprocessing.Process):
     def stop(self):
-        if self.is_alive():
-            self.terminate()
-            self.join()
-        return self.exitcode
+        self.terminate()
+        ret = self.wait()
+        self.close_sentinel()
+        return ret
 
     def poll(self):
-        return self.exitcode
-
-def start_s3_push_process(opts, args, conf, outdir):
-    p = Multiprocess(target=s3_push_process, args=(opts, args, conf, outdir))
-    p.start()
-    return p
-
-def s3_push_process(opts, args, conf, outdir):
-    def do_s3_push():
-        bucktup = aws.get_s3_output_bucket(conf)
-        for dirpath, dirnames, filenames in os.walk(outdir):
-            for f in filenames:
-                path = os.path.join(dirpath, f)
-                print("PUSH", path, "TO", aws.format_s3_url(bucktup, f))
-                aws.put_s3_file(conf, bucktup, path, f)
-            break
+        ret = subprocess.Popen.poll(self)
+        if ret is not None:
+            self.close_sentinel()
+        return ret
 
-    try:
-        error.retry(conf, do_s3_push)
-    except Exception as e:
-        print("S3 push failed:", e)
-        raise e
-    sys.exit(0)
+    def close_sentinel(self):
+        if self.sentinel is not None:
+            os.close(self.sentinel)
+            self.sentinel = None
+
+# max seconds between polls of processes that have no sentinel
+POLL_FALLBACK = 1.0
+
+# seconds before asking the work queue again after an empty read,
+# while a task slot is free
+RECEIVE_RETRY = 5.0
+
+def wait_events(procs, waitables, timeout):
+    """
+    Block until one of procs exits, one of waitables (objects
+    accepted by multiprocessing.connection.wait) is ready, or
+    timeout seconds have elapsed.  Processes without a sentinel
+    are polled at most every POLL_FALLBACK seconds.
+    """
+    sentinels = [p.sentinel for p in procs if p.sentinel is not None]
+    if len(sentinels) < len(procs):
+        timeout = min(timeout, POLL_FALLBACK)
+    waitables = sentinels + list(waitables)
+    if waitables:
+        multiprocessing.connection.wait(waitables, timeout)
+    elif timeout > 0:
+        time.sleep(timeout)
+
+def get_task_slots(conf):
+    """
+    Return the number of render tasks that may run concurrently
+    on this node.  TASK_SLOTS may be an integer or "auto", in which
+    case the number of slots is derived from the number of cores
+    and the amount of physical memory.
+    """
+    slots = conf.get('TASK_SLOTS', '1')
+    if slots == 'auto':
+        cores = multiprocessing.cpu_count()
+        try:
+            mem_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024*1024)
+        except (ValueError, OSError, AttributeError):
+            mem_mb = None
+        slots = cores // max(1, int(conf.get('TASK_SLOT_CORES', '8')))
+        if mem_mb is not None:
+            slots = min(slots, mem_mb // max(1, int(conf.get('TASK_SLOT_MEMORY', '4096'))))
+    else:
+        slots = int(slots)
+    return max(1, slots)
 
 def run_tasks(opts, args, conf):
     def write_done_file():
@@ -85,16 +120,67 @@ def run_tasks(opts, args, conf):
         # timestamp of completion of last task
         utils.write_atomic('task_last', "%d\n" % (time.time(),))
 
+    def record_task_time(task):
+        # append the render time of each frame (or subframe tile) of
+        # task to task_times, the cost profile read by brenda-work -C
+        outputs = set()
+        for f in task.journal['files']:
+            out = tiling.parse_output_name(f)
+            if out is not None:
+                outputs.add(out)
+        if outputs:
+            seconds = (time.time() - task.started) / len(outputs)
+            with open('task_times', 'a') as f:
+                for frame, tile in sorted(outputs, key=lambda o: (o[0], o[1] or ())):
+                    f.write("%d %.2f%s\n" % (frame, seconds, ''.join(" %s" % (v,) for v in tile or ())))
+
     def signal_handler(signal, frame):
         print("******* SIGNAL %r, exiting" % (signal,))
         cleanup_all()
         sys.exit(1)
 
     def cleanup_all():
-        tasks = (local.task_active, local.task_push)
-        local.task_active = local.task_push = None
-        for i, task in enumerate(tasks):
-            name = task_names[i]
+        # messages of committed tasks must still be deleted
+        try:
+            flush_deletes()
+        except Exception as e:
+            print("******* CLEANUP EXCEPTION sqs delete", e)
+        local.deletes = []
+
+        tasks = []
+        for slot in local.slots:
+            if slot.active:
+                tasks.append(("active/%d" % (slot.index,), slot.active))
+            slot.active = None
+        tasks.extend(('prefetch', task) for task in local.prefetch)
+
+        # Rendered tasks are kept in the spool, along with their
+        # messages, and are resumed when the task loop restarts.
+        # If we don't come back, the messages become visible again
+        # when their visibility timeout expires.
+        local.pushing = []
+        local.prefetch = []
+
+        # stop the upload worker
+        if local.uploader is not None:
+            try:
+                uploader = local.uploader
+                local.uploader = None
+                uploader.stop()
+            except Exception as e:
+                print("******* CLEANUP EXCEPTION uploader stop", e)
+
+        # immediately return all uncommitted tasks back to work queue
+        msgs = [task.msg for name, task in tasks if task.msg is not None]
+        for name, task in tasks:
+            task.msg = None
+        if msgs and local.q is not None:
+            try:
+                local.sqs_calls += aws.change_sqs_visibility(local.q, msgs, 0)
+            except Exception as e:
+                print("******* CLEANUP EXCEPTION sqs change_visibility", e)
+
+        for name, task in tasks:
             cleanup(task, name)
 
     def cleanup(task, name):
@@ -113,6 +199,14 @@ def run_tasks(opts, args, conf):
                     proc.stop()
                 except Exception as e:
                     print("******* CLEANUP EXCEPTION proc stop", name, e)
+            if task.watcher is not None:
+                watcher = task.watcher
+                task.watcher = None
+                watcher.close()
+            if task.script_fn is not None:
+                script_fn = task.script_fn
+                task.script_fn = None
+                utils.rm(script_fn)
             if task.outdir is not None:
                 try:
                     outdir = task.outdir
@@ -121,196 +215,466 @@ def run_tasks(opts, args, conf):
                 except Exception as e:
                     print("******* CLEANUP EXCEPTION rm outdir", name, task.outdir, e)
 
+    def node_idle():
+        # true if no task is rendering, pushing or prefetched, and
+        # no slot is pausing after a failed task
+        return not (local.prefetch or local.pushing or
+                    [slot for slot in local.slots if slot.active or slot.paused_until > time.time()])
+
+    def free_slots(now):
+        # slots that are ready for a task
+        return [slot for slot in local.slots if not slot.active and slot.paused_until <= now]
+
+    def task_failed(slot, task):
+        # A task that fails is given back to the work queue right
+        # away, to be retried here or elsewhere, and its slot pauses
+        # for error_pause seconds, while the other slots carry on.
+        # Only n_retries failed tasks in a row, with no task
+        # succeeding in between, bring the node down.
+        print("******* TASK", task.id, "FAILED in slot %d, exit status %d" % (slot.index, task.retcode))
+        slot.active = None
+        if task.watcher is not None:
+            local.uploader.abort(task.id)
+        cleanup(task, "active/%d" % (slot.index,))
+        local.failures += 1
+        if local.failures >= n_retries:
+            raise ValueError("FAIL after %d failed tasks in a row" % (local.failures,))
+        slot.paused_until = time.time() + error_pause
+
+    def held_tasks():
+        # all tasks for which we hold an SQS message
+        tasks = local.prefetch + local.pushing
+        tasks.extend(slot.active for slot in local.slots if slot.active)
+        return [task for task in tasks if task.msg is not None]
+
+    def upload_backlog_full():
+        # true if rendering should pause until uploads catch up
+        if len(local.pushing) > upload_backlog:
+            return True
+        if upload_backlog_mb and sum(t.push_bytes for t in local.pushing) >= upload_backlog_mb * 1048576:
+            return True
+        return False
+
+    def push_files(task, final):
+        """
+        Hand the complete output files of task to the upload worker.
+        With final set, the render is done, so all remaining files
+        are complete and the task is committed.
+        """
+        if task.watcher is not None:
+            files = task.watcher.ready(final)
+        elif final:
+            files = [(f, os.path.join(task.outdir, f)) for f in sorted(os.listdir(task.outdir))]
+            files = [(f, path) for f, path in files if os.path.isfile(path)]
+        else:
+            files = []
+        for f, path in files:
+            task.push_bytes += os.path.getsize(path)
+            local.uploader.push(task.id, path, f)
+        if final:
+            local.uploader.commit(task.id)
+
+    def heartbeat(now):
+        """
+        Tell SQS that we are still working on our tasks.  (If we
+        don't reassert with SQS frequently enough, it will assume we
+        died, and put our tasks back in the queue.  "frequently enough"
+        means within visibility_timeout.)  We reassert when a
+        message's remaining visibility drops below visibility_margin,
+        and reassert every other message that is at least halfway
+        there in the same batch, so that the deadlines of held
+        messages tend to line up.  Deletes are flushed once the oldest
+        has been held for delete_delay, or a batch is full, or the node
+        is idle.  Returns the time of the next heartbeat.
+        """
+        if local.deletes and (now >= local.deletes[0].committed + delete_delay
+                              or len(local.deletes) >= aws.SQS_BATCH_MAX
+                              or min(t.visible_until for t in local.deletes) - now < visibility_margin
+                              or node_idle()):
+            flush_deletes()
+        tasks = held_tasks()
+        if tasks and min(t.visible_until for t in tasks) - now < visibility_margin:
+            tasks = [t for t in tasks if t.visible_until - now < visibility_margin + visibility_timeout_reassert / 2.0]
+            print("******* REASSERT", [t.id for t in tasks])
+            local.sqs_calls += aws.change_sqs_visibility(local.q, [t.msg for t in tasks], visibility_timeout)
+            for t in tasks:
+                t.visible_until = now + visibility_timeout
+        deadlines = [t.visible_until - visibility_margin for t in held_tasks() + local.deletes]
+        if local.deletes:
+            deadlines.append(local.deletes[0].committed + delete_delay)
+        return min(deadlines) if deadlines else now + visibility_timeout_reassert
+
+    def flush_deletes():
+        # tell SQS that the tasks completed successfully
+        tasks = local.deletes
+        local.deletes = []
+        if tasks:
+            print("******* DELETE", [t.id for t in tasks])
+            local.sqs_calls += aws.delete_sqs_messages(local.q, [t.msg for t in tasks])
+            for t in tasks:
+                t.msg = None
+                spool.remove(spool_dir, t.key)
+
+    def new_task(msg, visible_until):
+        # initialize task object
+        task = State()
+        task.msg = msg
+        task.visible_until = visible_until
+        task.proc = None
+        task.watcher = None
+        task.push_bytes = 0
+        task.retcode = None
+        task.outdir = None
+        task.script_fn = None
+
+        # assign an ID to task, and a key that is unique
+        # across restarts for its spool entry
+        local.task_id_counter += 1
+        task.id = local.task_id_counter
+        task.key = "%s-%d" % (run_id, task.id)
+        return task
+
+    def spool_task(task, state):
+        # record task state in its spool journal
+        if state == spool.RENDERED:
+            files = [f for f in sorted(os.listdir(task.outdir)) if os.path.isfile(os.path.join(task.outdir, f))]
+            task.journal = dict(message_id=task.msg.message_id, receipt_handle=task.msg.receipt_handle,
+                                files=files, rendered=time.time())
+        task.journal['state'] = state
+        spool.write_journal(spool_dir, task.key, task.journal)
+
+    def resume_spool(q):
+        # Resume tasks left in the spool by an earlier run.  Their
+        # messages may have become visible again in the meantime, in
+        # which case SQS will reject the heartbeat and the delete, and
+        # the task will be rendered again elsewhere.  Otherwise, we
+        # reassert right away.
+        now = time.time()
+        for key, entry in spool.recover(spool_dir):
+            task = new_task(q.Message(entry['receipt_handle']), now)
+            task.key = key
+            task.journal = entry
+            print("******* TASK", task.id, "RESUMED from spool", key, entry['state'])
+            if entry['state'] == spool.COMMITTED:
+                task.committed = now
+                local.deletes.append(task)
+            else:
+                task.outdir = spool.outdir(spool_dir, key)
+                for f in entry['files']:
+                    path = os.path.join(task.outdir, f)
+                    task.push_bytes += os.path.getsize(path)
+                    local.uploader.push(task.id, path, f)
+                local.uploader.commit(task.id)
+                local.pushing.append(task)
+
+    def prepare_task(msg, received):
+        task = new_task(msg, received + visibility_timeout)
+
+        # get the task script, expanding template messages
+        script = template.task_script(conf, task.msg.body, template_dir)
+        print("script len:", len(script))
+
+        # create output directory in the spool
+        task.outdir = spool.outdir(spool_dir, task.key)
+        utils.rmtree(task.outdir)
+        utils.mkdir(task.outdir)
+
+        # do macro substitution on the task script
+        script = script.replace('$OUTDIR', task.outdir)
+
+        # add shebang if absent
+        if not script.startswith("#!"):
+            script = "#!/bin/bash\n" + script
+
+        # write script file and make it executable (each task gets
+        # its own script file, because several may run at once)
+        task.script_fn = os.path.join(work_dir, "brenda-go%d.tmp" % (task.id,))
+        with open(task.script_fn, 'w') as f:
+            f.write(script)
+        st = os.stat(task.script_fn)
+        os.chmod(task.script_fn, st.st_mode | (stat.S_IEXEC|stat.S_IXGRP|stat.S_IXOTH))
+        task.script = script
+        return task
+
+    def start_task(slot, task):
+        # register active task
+        slot.active = task
+
+        # cd to project directory, where we will run blender from
+        with utils.Cd(proj_dir) as cd:
+            # run the script
+            print("------- Run script %s (slot %d) -------" % (task.script_fn, slot.index))
+            print(task.script, end=' ')
+            print("--------------------------")
+            task.started = time.time()
+            task.proc = Subprocess([task.script_fn])
+
+        # in streaming mode, push frames to S3 as they are rendered
+        if stream_push:
+            task.watcher = utils.DirWatcher(task.outdir, stream_push_settle)
+
+        print("active task:", task.__dict__)
+
     def task_loop():
         try:
             # reset tasks
-            local.task_active = None
-            local.task_push = None
+            for slot in local.slots:
+                slot.active = None
+                slot.paused_until = 0
+            local.pushing = []
+            local.prefetch = []
+            local.deletes = []
 
             # get SQS work queue
-            q = aws.get_sqs_queue(conf)
-
-            # Loop over tasks.  There are up to two different tasks at any
-            # given moment that we are processing concurrently:
-            #
-            # 1. Active task -- usually a blender render operation.
-            # 2. S3 push task -- a task which pushes the products of the
-            #                    previous active task (such as rendered
-            #                    frames) to S3.
+            q = local.q = aws.get_sqs_queue(conf)
+
+            # start the upload worker, which keeps its S3 connections
+            # warm across tasks
+            local.uploader = upload.Uploader(conf)
+
+            # pick up where an earlier run left off
+            resume_spool(q)
+
+            # Loop over tasks.  Each slot holds an active task --
+            # usually a blender render operation.  When it completes,
+            # its products (such as rendered frames) are handed to the
+            # upload worker, and the slot is free for the next task
+            # while the push proceeds in the background.  Rendering
+            # pauses if the upload backlog grows beyond upload_backlog
+            # tasks or upload_backlog_mb megabytes.  Rather than
+            # polling, we sleep until a process exits, an upload
+            # completes, or it is time to talk to SQS.
+            retry_receive = 0
+            backlog_full = False
             while True:
-                # reset active task
-                local.task_active = None
-
-                # initialize active task object
-                task = State()
-                task.msg = None
-                task.proc = None
-                task.retcode = None
-                task.outdir = None
-                task.id = 0
-
-                # Get a task from the SQS work queue.  This is normally
-                # a short script that runs blender to render one
-                # or more frames.
-                _messages = q.receive_messages(MaxNumberOfMessages=1)
-                task.msg = None if len(_messages) < 1 else _messages[0]
-
-                # output some debug info
-                print("queue read:", task.msg)
-                if local.task_push:
-                    print("push task:", local.task_push.__dict__)
+                want_work = (time.time() >= retry_receive)
+
+                # Check for tasks whose output has been pushed to S3.
+                # Deletes are batched, so hold on to the message until then.
+                for task_id, ok, info in local.uploader.results():
+                    if not ok:
+                        raise ValueError("fatal error in push task %d: %s" % (task_id, info))
+                    task = [t for t in local.pushing if t.id == task_id][0]
+                    local.pushing.remove(task)
+                    local.task_count += 1
+                    print("******* TASK", task.id, "COMMITTED to S3 (SQS calls per task: %.2f)" % (
+                        float(local.sqs_calls) / local.task_count,))
+                    task_complete_accounting(local.task_count)
+                    spool_task(task, spool.COMMITTED)
+                    done = State()
+                    done.id = task.id
+                    done.key = task.key
+                    done.msg = task.msg
+                    done.visible_until = task.visible_until
+                    done.committed = time.time()
+                    local.deletes.append(done)
+                    task.msg = None
+                    cleanup(task, 'push')
+
+                    # the upload backlog may have room now
+                    want_work = True
+                if not local.uploader.alive():
+                    raise ValueError("upload worker exited")
+
+                # Check active tasks for completion.
+                for slot in local.slots:
+                    if slot.paused_until and slot.paused_until <= time.time():
+                        # a slot is done pausing after a failed task
+                        slot.paused_until = 0
+                        want_work = True
+                    task = slot.active
+                    if task:
+                        # in streaming mode, push files that are complete
+                        if task.watcher is not None:
+                            push_files(task, False)
+
+                        # test if process has finished
+                        task.retcode = task.proc.poll()
+                        if task.retcode is not None:
+                            # process has finished
+                            task.proc = None
+
+                            # did process finish with errors?
+                            if task.retcode != 0:
+                                task_failed(slot, task)
+                                want_work = True
+                                continue
+
+                            # Process finished successfully.  Commit its files to S3.
+                            print("******* TASK", task.id, "READY-FOR-PUSH")
+                            local.failures = 0
+                            spool_task(task, spool.RENDERED)
+                            record_task_time(task)
+                            push_files(task, True)
+                            if task.watcher is not None:
+                                task.watcher.close()
+                                task.watcher = None
+                            local.pushing.append(task)
+                            slot.active = None
+
+                            # a slot is free now
+                            want_work = True
+
+                # Idle slots start on prefetched tasks first, since their
+                # output directory and script are already prepared.
+                # While the upload backlog is full, slots stay idle.
+                idle = free_slots(time.time())
+                if upload_backlog_full():
+                    if idle and not backlog_full:
+                        print("******* UPLOAD BACKLOG FULL (%d tasks), pausing render" % (len(local.pushing),))
+                    backlog_full = True
+                    idle = []
                 else:
-                    print("no task push task")
-
-                # process task
-                if task.msg is not None:
-                    # assign an ID to task
-                    local.task_id_counter += 1
-                    task.id = local.task_id_counter
-
-                    # register active task
-                    local.task_active = task
-
-                    # create output directory
-                    task.outdir = os.path.join(work_dir, "brenda-outdir%d.tmp" % (task.id,))
-                    utils.rmtree(task.outdir)
-                    utils.mkdir(task.outdir)
-
-                    # get the task script
-                    script = task.msg.body
-                    print("script len:", len(script))
-
-                    # do macro substitution on the task script
-                    script = script.replace('$OUTDIR', task.outdir)
-
-                    # add shebang if absent
-                    if not script.startswith("#!"):
-                        script = "#!/bin/bash\n" + script
-
-                    # cd to project directory, where we will run blender from
-                    with utils.Cd(proj_dir) as cd:
-                        # write script file and make it executable
-                        script_fn = "./brenda-go"
-                        with open(script_fn, 'w') as f:
-                            f.write(script)
-                        st = os.stat(script_fn)
-                        os.chmod(script_fn, st.st_mode | (stat.S_IEXEC|stat.S_IXGRP|stat.S_IXOTH))
-
-                        # run the script
-                        print("------- Run script %s -------" % (os.path.realpath(script_fn),))
-                        print(script, end=' ')
-                        print("--------------------------")
-                        task.proc = Subprocess([script_fn])
-
-                    print("active task:", local.task_active.__dict__)
-
-                # Wait for active and S3-push tasks to complete,
-                # while periodically reasserting with SQS to
-                # acknowledge that tasks are still pending.
-                # (If we don't reassert with SQS frequently enough,
-                # it will assume we died, and put our tasks back
-                # in the queue.  "frequently enough" means within
-                # visibility_timeout.)
-                count = 0
-                while True:
-                    reassert = (count >= visibility_timeout_reassert)
-                    for i, task in enumerate((local.task_active, local.task_push)):
-                        if task:
-                            name = task_names[i]
-                            if task.proc is not None:
-                                # test if process has finished
-                                task.retcode = task.proc.poll()
-                                if task.retcode is not None:
-                                    # process has finished
-                                    task.proc = None
-
-                                    # did process finish with errors?
-                                    if task.retcode != 0:
-                                        errtxt = "fatal error in %s task" % (name,)
-                                        if name == 'active':
-                                            raise error.ValueErrorRetry(errtxt)
-                                        else:
-                                            raise ValueError(errtxt)
-
-                                    # Process finished successfully.  If S3-push process,
-                                    # tell SQS that the task completed successfully.
-                                    if name == 'push':
-                                        print("******* TASK", task.id, "COMMITTED to S3")
-                                        q.delete_messages(Entries=[
-                                            {
-                                                'Id': task.msg.message_id,
-                                                'ReceiptHandle': task.msg.receipt_handle
-                                            },
-                                        ])
-                                        task.msg = None
-                                        local.task_count += 1
-                                        task_complete_accounting(local.task_count)
-
-                                    # active task completed?
-                                    if name == 'active':
-                                        print("******* TASK", task.id, "READY-FOR-PUSH")
-
-                            # tell SQS that we are still working on the task
-                            if reassert and task.proc is not None:
-                                print("******* REASSERT", name, task.id)
-                                task.msg.change_visibility(VisibilityTimeout=visibility_timeout)
-
-                    # break out of loop only when no pending tasks remain
-                    if ((not local.task_active or local.task_active.proc is None)
-                        and (not local.task_push or local.task_push.proc is None)):
-                        break
-
-                    # setup for next process poll iteration
-                    if reassert:
-                        count = 0
-                    time.sleep(1)
-                    count += 1
-
-                # clean up the S3-push task
-                cleanup(local.task_push, 'push')
-                local.task_push = None
-
-                # start a concurrent push task to commit files generated by
-                # just-completed active task (such as blender render frames) to S3
-                if local.task_active:
-                    local.task_active.proc = start_s3_push_process(opts, args, conf, local.task_active.outdir)
-                    local.task_push = local.task_active
-                    local.task_active = None
-
-                # if no active task and no S3-push task, we are done (unless DONE is set to "poll")
-                if not local.task_active and not local.task_push:
+                    backlog_full = False
+                while idle and local.prefetch:
+                    start_task(idle.pop(0), local.prefetch.pop(0))
+
+                # Get tasks from the SQS work queue for idle slots, plus
+                # up to task_prefetch tasks to be held in reserve.  This is
+                # normally a short script that runs blender to render one
+                # or more frames.  Don't ask again after an empty read until
+                # something changes, or RECEIVE_RETRY passes if a slot is
+                # free, else the reassert period elapses.
+                n_wanted = len(idle) + task_prefetch - len(local.prefetch)
+                if n_wanted > 0 and want_work:
+                    # If the node has nothing else to do, long poll the
+                    # work queue, so that new work is picked up as soon
+                    # as it arrives without a stream of empty receives.
+                    # Unless polling, wait just long enough to be sure
+                    # the queue is empty before we exit.
+                    wait_time = 0
+                    if node_idle():
+                        flush_deletes()
+                        wait_time = sqs_wait_time
+                        if read_done_file() != "poll":
+                            wait_time = min(wait_time, 1)
+                    received = time.time()
+                    messages = q.receive_messages(MaxNumberOfMessages=min(n_wanted, aws.SQS_BATCH_MAX),
+                                                  WaitTimeSeconds=wait_time)
+                    local.sqs_calls += 1
+                    print("queue read:", messages)
+                    if messages:
+                        local.empty_polls = 0
+                    else:
+                        retry_receive = received + (RECEIVE_RETRY if idle else visibility_timeout_reassert)
+                        if wait_time or not sqs_wait_time:
+                            local.empty_polls += 1
+                    for i, msg in enumerate(messages):
+                        try:
+                            task = prepare_task(msg, received)
+                        except Exception:
+                            # return this and the rest of the batch to the
+                            # work queue now, rather than leaving them
+                            # invisible until their timeout expires
+                            try:
+                                local.sqs_calls += aws.change_sqs_visibility(q, messages[i:], 0)
+                            except Exception as e:
+                                print("******* CLEANUP EXCEPTION sqs change_visibility", e)
+                            raise
+                        if idle:
+                            start_task(idle.pop(0), task)
+                        else:
+                            print("******* TASK", task.id, "PREFETCHED")
+                            local.prefetch.append(task)
+
+                # if no task is rendering or pushing, we are
+                # done (unless DONE is set to "poll")
+                if node_idle():
+                    flush_deletes()
                     if read_done_file() == "poll":
-                        print("Polling for more work...")
-                        time.sleep(15)
+                        # back off after repeated empty polls, if configured
+                        pause = min(poll_backoff * 2 ** max(0, local.empty_polls - 1), poll_backoff_max)
+                        if pause > 0:
+                            print("Polling for more work in %g seconds..." % (pause,))
+                            time.sleep(pause)
+                        else:
+                            print("Polling for more work...")
+                        retry_receive = 0
+                        continue
                     else:
                         break
 
+                # reassert with SQS and flush deletes as needed
+                now = time.time()
+                next_sqs = heartbeat(now)
+                if len(local.prefetch) < task_prefetch or (free_slots(now) and not backlog_full):
+                    next_sqs = min(next_sqs, retry_receive)
+                paused = [slot.paused_until for slot in local.slots if slot.paused_until > now]
+                if paused:
+                    next_sqs = min(next_sqs, min(paused))
+                timeout = next_sqs - now
+
+                # wait for the next process exit, upload result, output
+                # file or SQS deadline
+                procs = []
+                waitables = local.uploader.waitables()
+                for slot in local.slots:
+                    task = slot.active
+                    if task:
+                        procs.append(task.proc)
+                        if task.watcher is not None:
+                            if task.watcher.fileno() is not None:
+                                waitables.append(task.watcher.fileno())
+                            else:
+                                timeout = min(timeout, task.watcher.timeout())
+                wait_events(procs, waitables, max(0, timeout))
+
         finally:
             cleanup_all()
 
-    # initialize task_active and task_push states
-    task_names = ('active', 'push')
+    # get configuration parameters
+    work_dir = aws.get_work_dir(conf)
+    spool_dir = spool.get_spool_dir(work_dir)
+    template_dir = os.path.join(work_dir, 'templates')
+    run_id = "%d-%d" % (time.time(), os.getpid())
+    visibility_timeout = int(conf.get('VISIBILITY_TIMEOUT', '120'))
+    visibility_timeout_reassert = int(conf.get('VISIBILITY_TIMEOUT_REASSERT', str(visibility_timeout // 2)))
+    visibility_margin = visibility_timeout - visibility_timeout_reassert
+    delete_delay = float(conf.get('SQS_DELETE_DELAY', '5'))
+    sqs_wait_time = min(int(conf.get('SQS_WAIT_TIME', '20')), 20)
+    poll_backoff = float(conf.get('POLL_BACKOFF', '0' if sqs_wait_time else '15'))
+    poll_backoff_max = float(conf.get('POLL_BACKOFF_MAX', '300' if sqs_wait_time else str(poll_backoff)))
+    n_retries = int(conf.get('N_RETRIES', '5'))
+    error_pause = int(conf.get('ERROR_PAUSE', '30'))
+    n_slots = get_task_slots(conf)
+    task_prefetch = int(conf.get('TASK_PREFETCH', '0'))
+    stream_push = int(conf.get('STREAM_PUSH', '0'))
+    stream_push_settle = float(conf.get('STREAM_PUSH_SETTLE', '2'))
+    upload_backlog = int(conf.get('UPLOAD_BACKLOG', str(n_slots)))
+    upload_backlog_mb = float(conf.get('UPLOAD_BACKLOG_MB', '0'))
+    print("Task slots:", n_slots, "prefetch:", task_prefetch)
+
+    # initialize per-slot task_active states
     local = State()
-    local.task_active = None
-    local.task_push = None
+    local.slots = []
+    for i in range(n_slots):
+        slot = State()
+        slot.index = i
+        slot.active = None
+        slot.paused_until = 0
+        local.slots.append(slot)
+    local.pushing = []
+    local.uploader = None
+    local.prefetch = []
+    local.deletes = []
+    local.q = None
     local.task_id_counter = 0
     local.task_count = 0
+    local.sqs_calls = 0
+    local.empty_polls = 0
+    local.failures = 0
 
     # setup signal handler
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    # get configuration parameters
-    work_dir = aws.get_work_dir(conf)
-    visibility_timeout_reassert = int(conf.get('VISIBILITY_TIMEOUT_REASSERT', '30'))
-    visibility_timeout = int(conf.get('VISIBILITY_TIMEOUT', '120'))
-
     # validate RENDER_OUTPUT bucket
     aws.get_s3_output_bucket(conf)
 
     # file cleanup
     utils.rm('task_count')
     utils.rm('task_last')
+    utils.rm('task_times')
 
     # create Blender temporary directory
     tmp_dir = os.path.join(work_dir, 'tmp')
@@ -337,8 +701,12 @@ def run_tasks(opts, args, conf):
         raise ValueError("BLENDER_PROJECT not defined in configuration")
 
     # directory that blender will be run from
+    start_time = time.time()
     proj_dir = get_project(conf, blender_project)
     print("PROJ_DIR", proj_dir)
+    uptime = utils.uptime()
+    print("******* PROJECT READY in %.2f seconds%s" % (
+        time.time() - start_time, " (%.2f seconds after boot)" % (uptime,) if uptime is not None else ""))
 
     # mount additional EBS volumes
     aws.mount_additional_ebs(conf, proj_dir)
@@ -360,7 +728,87 @@ def run_tasks(opts, args, conf):
                     print("Error canceling spot instance request:", e)
             utils.shutdown()
 
-        print("******* DONE (%d tasks completed)" % (local.task_count,))
+        print("******* DONE (%d tasks completed, %d SQS calls)" % (local.task_count, local.sqs_calls))
+
+# archive types that are extracted by tar while they are
+# downloaded, and the tar options to read them from a pipe
+TAR_STREAM_FORMATS = (
+    ('.tar', []),
+    ('.tar.gz', ['-z']),
+    ('.tgz', ['-z']),
+    ('.tar.bz2', ['-j']),
+    ('.tbz2', ['-j']),
+    ('.tar.xz', ['-J']),
+    ('.txz', ['-J']),
+    ('.tar.zst', ['--zstd']),
+    ('.tzst', ['--zstd']),
+    )
+
+def tar_stream_options(fn):
+    for ext, tar_opts in TAR_STREAM_FORMATS:
+        if fn.lower().endswith(ext):
+            return tar_opts
+    return None
+
+def extract_tar_stream(conf, s3url, etag, tar_opts):
+    # pipe the S3 file into tar as it is downloaded
+    obj = aws.S3Object(conf, s3url, etag)
+    cmd = ["tar", "xf", "-"] + tar_opts
+    print("***", cmd)
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        ret = aws.s3_get_stream(conf, obj, proc.stdin.write)
+    except:
+        proc.kill()
+        raise
+    finally:
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        status = proc.wait()
+    if status != 0:
+        raise ValueError("command failed with status %r (expected 0)" % (status,))
+    return ret
+
+def extract_zip_ranges(conf, s3url, etag):
+    """
+    Extract a zip file in S3 without downloading all of it first.
+    The central directory is read with ranged GETs, then the members
+    are split into CURL_MAX_THREADS runs of about equal size that are
+    extracted in parallel, each run reading its part of the file.
+    """
+    def extract(members):
+        with zipfile.ZipFile(aws.S3RangeFile(obj)) as zf:
+            for info in members:
+                mode = info.external_attr >> 16
+                if stat.S_ISLNK(mode):
+                    path = os.path.normpath(info.filename)
+                    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    os.symlink(zf.read(info).decode('utf-8'), path)
+                    continue
+                path = zf.extract(info)
+                if mode & 0o777 and not info.is_dir():
+                    os.chmod(path, mode & 0o777)
+
+    max_threads = max(1, int(conf.get('CURL_MAX_THREADS', '16')))
+    obj = aws.S3Object(conf, s3url, etag)
+    start_time = time.time()
+    with zipfile.ZipFile(aws.S3RangeFile(obj)) as zf:
+        members = sorted(zf.infolist(), key=lambda info: info.header_offset)
+    total = sum(info.compress_size for info in members)
+    runs = [[] for i in range(max_threads)]
+    done = 0
+    for info in members:
+        runs[min(done * max_threads // max(total, 1), max_threads - 1)].append(info)
+        done += info.compress_size
+    runs = [r for r in runs if r]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(runs))) as pool:
+        for f in [pool.submit(extract, r) for r in runs]:
+            f.result()
+    obj.report(start_time, len(runs))
+    return obj.content_len, obj.etag
 
 def get_s3_project(conf, s3url, proj_dir):
     # target file in which to save S3 download
@@ -385,21 +833,28 @@ def get_s3_project(conf, s3url, proj_dir):
 
     try:
         with utils.Cd(new_dir) as cd:
-            # download the file from S3
-            file_len, etag = aws.s3_get(conf, s3url, fn, etag=etag)
+            # Download the file from S3, unless we already have it.
+            # Tar and zip files are extracted while they download,
+            # without a local copy of the archive.  Anything else
+            # is downloaded first, then extracted with "tar xf".
+            tar_opts = tar_stream_options(fn)
+            try:
+                if tar_opts is not None:
+                    file_len, etag = extract_tar_stream(conf, s3url, etag, tar_opts)
+                elif fn.lower().endswith('.zip'):
+                    file_len, etag = extract_zip_ranges(conf, s3url, etag)
+                else:
+                    file_len, etag = aws.s3_get(conf, s3url, fn, etag=etag)
+                    utils.system(["tar", "xf", fn])
+                    utils.rm(fn)
+            except error.ETagMatch:
+                print("Project %s is unchanged (ETag %s), using %s" % (s3url, etag, proj_dir))
+                return
 
             # save the etag for future reference
             with open(fn + '.etag', 'w') as efn:
                 efn.write(etag+'\n')
 
-            # Use "unzip" tool for .zip files,
-            # and "tar xf" for everything else.
-            if fn.lower().endswith('.zip'):
-                utils.system(["unzip", fn])
-            else:
-                utils.system(["tar", "xf", fn])
-            utils.rm(fn)
-
         utils.rmtree(proj_dir)
         utils.mv(new_dir, proj_dir)
 
@@ -421,6 +876,20 @@ def get_project(conf, url):
             proj_dir = os.path.join(work_dir, "brenda-project.mount")
             dev = utils.blkdev(0, mount_form=True)
             utils.mount(dev, proj_dir)
+        elif manifest.is_manifest_url(url):
+            proj_dir = os.path.join(work_dir, "brenda-project.tmp")
+
+            # share project objects with other nodes, if enabled
+            server = fetcher = None
+            peer_port = conf.get('PEER_PORT')
+            if peer_port:
+                server = peer.PeerServer(int(peer_port), peer.get_peer_host(conf))
+                fetcher = peer.PeerFetcher(conf, peer.get_peers(conf, url, exclude=server.addr))
+                peer.keep_registered(conf, url, server.addr)
+                atexit.register(peer.unregister, conf, url, server.addr)
+
+            manifest.sync(conf, url, proj_dir, refetch=int(conf.get('BLENDER_PROJECT_ALWAYS_REFETCH', '0')),
+                          server=server, fetcher=fetcher)
         else:
             proj_dir = os.path.join(work_dir, "brenda-project.tmp")
             get_s3_project(conf, url, proj_dir)
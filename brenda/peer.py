@@ -0,0 +1,227 @@
+from __future__ import print_function
+# Brenda -- Blender render tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Peer-to-peer distribution of manifest project objects (see
+# manifest.py) between render farm nodes.  Each node serves the
+# objects it has over plain HTTP on PEER_PORT:
+#
+#   GET /objects/SHA256  -- content of the object, or 404
+#
+# and registers its address in S3 next to the manifest, i.e.
+# s3://BUCKET/myproject.peers/HOST:PORT, where other nodes look for
+# peers.  Nodes usually end without unregistering (e.g. when a spot
+# instance is reclaimed), so each node renews its registration every
+# PEER_TTL / 3 seconds, and registrations older than PEER_TTL are
+# ignored and removed.  Objects fetched from a peer are verified
+# against their hash, and fetched from S3 if no peer has a good copy.
+
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+import os, re, time, calendar, random, socket, hashlib, threading, shutil
+import http.server, socketserver, urllib.request, urllib.error
+from brenda import aws
+
+def peers_url(s3url):
+    return s3url[:-len('.manifest')] + '.peers/'
+
+class PeerServer(object):
+    """
+    HTTP server, running on a daemon thread, that serves the
+    objects added with add() or set_objects().
+    """
+
+    def __init__(self, port, host):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.served = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                m = re.match(r'^/objects/([0-9a-f]{64})$', self.path)
+                path = server.get(m.group(1)) if m else None
+                try:
+                    f = open(path, 'rb') if path else None
+                except (IOError, OSError):
+                    f = None
+                if f is None:
+                    self.send_error(404)
+                    return
+                with f:
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+                    self.end_headers()
+                    shutil.copyfileobj(f, self.wfile, 1048576)
+                with server.lock:
+                    server.served += 1
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = socketserver.ThreadingTCPServer(('', port), Handler, bind_and_activate=False)
+        self.httpd.daemon_threads = True
+        self.httpd.allow_reuse_address = True
+        self.httpd.server_bind()
+        self.httpd.server_activate()
+        self.addr = "%s:%d" % (host, self.httpd.server_address[1])
+        t = threading.Thread(target=self.httpd.serve_forever)
+        t.daemon = True
+        t.start()
+        print("PEER SERVER listening on", self.addr)
+
+    def get(self, h):
+        with self.lock:
+            return self.objects.get(h)
+
+    def add(self, h, path):
+        with self.lock:
+            self.objects[h] = path
+
+    def set_objects(self, objects):
+        with self.lock:
+            self.objects = dict(objects)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def get_peer_host(conf):
+    # address that other nodes can reach us at
+    host = conf.get('PEER_HOST')
+    if not host:
+        if int(conf.get('RUNNING_ON_EC2', '1')):
+            host = aws.get_local_ipv4_self()
+        else:
+            host = '127.0.0.1'
+    return host
+
+def peer_ttl(conf):
+    return float(conf.get('PEER_TTL', '600'))
+
+def register(conf, s3url, addr):
+    bucket, key = aws.parse_s3_url(peers_url(s3url) + addr)
+    aws.get_s3_client(conf).put_object(Bucket=bucket, Key=key, Body=b'')
+
+def keep_registered(conf, s3url, addr):
+    """
+    Register addr as a peer, and renew the registration (its S3
+    timestamp) on a daemon thread for as long as we run.
+    """
+    register(conf, s3url, addr)
+    def renew():
+        while True:
+            time.sleep(peer_ttl(conf) / 3.0)
+            try:
+                register(conf, s3url, addr)
+            except Exception as e:
+                print("Error renewing peer registration:", e)
+    t = threading.Thread(target=renew)
+    t.daemon = True
+    t.start()
+
+def unregister(conf, s3url, addr):
+    try:
+        bucket, key = aws.parse_s3_url(peers_url(s3url) + addr)
+        aws.get_s3_client(conf).delete_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        print("Error unregistering peer:", e)
+
+def get_peers(conf, s3url, exclude=None):
+    """
+    Return the addresses of the peers registered for the project
+    at s3url, or given by PEERS.  Registrations that haven't been
+    renewed within PEER_TTL, of nodes that are likely gone, are
+    skipped and removed.
+    """
+    peers = [p for p in conf.get('PEERS', '').split(',') if p]
+    if not peers:
+        bucket, prefix = aws.parse_s3_url(peers_url(s3url))
+        client = aws.get_s3_client(conf)
+        oldest = time.time() - peer_ttl(conf)
+        stale = []
+        for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for o in page.get('Contents', []):
+                if calendar.timegm(o['LastModified'].utctimetuple()) < oldest:
+                    stale.append(o['Key'])
+                else:
+                    peers.append(o['Key'][len(prefix):])
+        for key in stale:
+            try:
+                client.delete_object(Bucket=bucket, Key=key)
+            except Exception as e:
+                print("Error removing stale peer:", e)
+        if stale:
+            print("PEER removed %d stale registrations" % (len(stale),))
+    return [p for p in peers if p != exclude]
+
+class PeerFetcher(object):
+    """
+    Fetches objects from a random choice of up to PEER_TRIES peers.
+    A peer that can't be reached is not asked again.
+    """
+
+    def __init__(self, conf, peers):
+        self.peers = list(peers)
+        self.tries = int(conf.get('PEER_TRIES', '3'))
+        self.timeout = float(conf.get('PEER_TIMEOUT', '10'))
+        self.lock = threading.Lock()
+        self.fetched = 0
+        self.bytes = 0
+
+    def fetch(self, h, path):
+        """
+        Fetch object h into path.  Return True if a peer had a
+        copy that matches the hash, else False.
+        """
+        with self.lock:
+            peers = random.sample(self.peers, min(self.tries, len(self.peers)))
+        for p in peers:
+            try:
+                resp = urllib.request.urlopen("http://%s/objects/%s" % (p, h), timeout=self.timeout)
+            except urllib.error.HTTPError:
+                continue
+            except Exception as e:
+                print("PEER %s unreachable: %s" % (p, e))
+                with self.lock:
+                    if p in self.peers:
+                        self.peers.remove(p)
+                continue
+            try:
+                sha = hashlib.sha256()
+                n = 0
+                with open(path, 'wb') as f:
+                    while True:
+                        data = resp.read(1048576)
+                        if not data:
+                            break
+                        sha.update(data)
+                        f.write(data)
+                        n += len(data)
+            except Exception as e:
+                print("PEER %s: error fetching %s: %s" % (p, h, e))
+                continue
+            finally:
+                resp.close()
+            if sha.hexdigest() != h:
+                print("PEER %s: hash mismatch for %s" % (p, h))
+                continue
+            with self.lock:
+                self.fetched += 1
+                self.bytes += n
+            return True
+        return False
@@ -279,6 +279,7 @@ cd "$B"
         "SQS_REGION",
         "CURL_MAX_THREADS",
         "CURL_N_RETRIES",
+        "CURL_CHUNK_SIZE",
         "CURL_DEBUG",
         "VISIBILITY_TIMEOUT",
         "VISIBILITY_TIMEOUT_REASSERT",
@@ -288,7 +289,28 @@ cd "$B"
         "BLENDER_PROJECT_ALWAYS_REFETCH",
         "WORK_DIR",
         "SHUTDOWN",
-        "DONE"
+        "DONE",
+        "TASK_SLOTS",
+        "TASK_SLOT_CORES",
+        "TASK_SLOT_MEMORY",
+        "TASK_PREFETCH",
+        "SQS_DELETE_DELAY",
+        "SQS_WAIT_TIME",
+        "POLL_BACKOFF",
+        "POLL_BACKOFF_MAX",
+        "STREAM_PUSH",
+        "STREAM_PUSH_SETTLE",
+        "S3_UPLOAD_THREADS",
+        "S3_MULTIPART_THRESHOLD",
+        "S3_MULTIPART_CHUNKSIZE",
+        "S3_MULTIPART_CONCURRENCY",
+        "UPLOAD_BACKLOG",
+        "UPLOAD_BACKLOG_MB",
+        "PEER_PORT",
+        "PEER_TRIES",
+        "PEER_TIMEOUT",
+        "PEER_TTL",
+        "TASK_TEMPLATES",
         ] + list(aws.additional_ebs_iterator(conf))
 
     script = head
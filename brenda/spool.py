@@ -0,0 +1,99 @@
+from __future__ import print_function
+# Brenda -- Blender render tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The spool is a directory on the work dir that holds the output
+# directory of every task, plus a small journal for each task that
+# has finished rendering:
+#
+#   <key>.out/   -- task output directory ($OUTDIR)
+#   <key>.json   -- journal: SQS message, output files and state
+#
+# A journal in the 'rendered' state means that the files in the
+# output directory are complete but may not all be in S3 yet.  In
+# the 'committed' state, all files are in S3 and only the delete of
+# the SQS message may be outstanding.  Journals are written atomically,
+# so after a crash or restart, the node can resume pushing rendered
+# output and deleting messages rather than render the task again.
+# Output directories without a journal belong to renders that never
+# finished, and are discarded.
+
+import os, json
+from brenda import utils
+
+RENDERED = 'rendered'
+COMMITTED = 'committed'
+
+def get_spool_dir(work_dir):
+    spool_dir = os.path.join(work_dir, 'spool')
+    if not os.path.isdir(spool_dir):
+        utils.makedirs(spool_dir)
+    return spool_dir
+
+def outdir(spool_dir, key):
+    return os.path.join(spool_dir, key + '.out')
+
+def journal_fn(spool_dir, key):
+    return os.path.join(spool_dir, key + '.json')
+
+def write_journal(spool_dir, key, entry):
+    utils.write_atomic(journal_fn(spool_dir, key), json.dumps(entry, sort_keys=True) + '\n', sync=True)
+
+def remove(spool_dir, key):
+    utils.rm(journal_fn(spool_dir, key))
+    utils.rmtree(outdir(spool_dir, key))
+
+def recover(spool_dir):
+    """
+    Return a list of (key, entry) for the journals in spool_dir,
+    oldest first.  Output directories of unfinished renders and
+    journals that can't be resumed are removed.
+    """
+    ret = []
+    keys = set()
+    for fn in sorted(os.listdir(spool_dir)):
+        key, ext = os.path.splitext(fn)
+        if ext != '.json':
+            continue
+        try:
+            with open(os.path.join(spool_dir, fn)) as f:
+                entry = json.load(f)
+            if entry['state'] == RENDERED:
+                od = outdir(spool_dir, key)
+                for name in entry['files']:
+                    if not os.path.isfile(os.path.join(od, name)):
+                        raise ValueError("missing output file %s" % (name,))
+            elif entry['state'] != COMMITTED:
+                raise ValueError("unknown state %r" % (entry['state'],))
+        except Exception as e:
+            print("******* SPOOL: discarding journal", fn, e)
+            remove(spool_dir, key)
+            continue
+        keys.add(key)
+        ret.append((key, entry))
+
+    # remove everything else, such as output of unfinished renders
+    for fn in os.listdir(spool_dir):
+        key, ext = os.path.splitext(fn)
+        if key not in keys or ext not in ('.json', '.out'):
+            path = os.path.join(spool_dir, fn)
+            if os.path.isdir(path):
+                utils.rmtree(path)
+            else:
+                utils.rm(path)
+
+    ret.sort(key=lambda ke: ke[1].get('rendered', 0))
+    return ret
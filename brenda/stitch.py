@@ -0,0 +1,459 @@
+from __future__ import division
+from __future__ import print_function
+# Brenda -- Blender render tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Stitch the subframe tiles of rendered frames back into whole frames.
+# The bounds of each tile come from its name, as produced by the
+# subframe task script sample, i.e. frame_000042_X-0.0-0.5-Y-0.5-1.0.png.
+# Blender renders a border as a full-size image that is empty outside
+# the border, unless the render has use_crop_to_border set, in which
+# case the image is only the size of the border.  Both kinds of tile
+# are placed by array slicing into a memory-mapped scratch file of the
+# frame, so that an 8K or 16K frame needn't fit in memory.  EXR tiles
+# are read a band of scanlines at a time, so with EXR (or with tiles
+# cropped to their borders) memory use is bounded by the tile size,
+# rather than the frame size.  OpenCV can only read an image whole, so
+# each full-size PNG or TIFF tile is a frame's worth of memory while it
+# is placed.
+#
+# Images are read and written with OpenCV (PNG, TIFF, etc., including
+# 16-bit PNG) or OpenEXR (EXR, any channels and pixel types), which
+# like NumPy are only needed here:
+#
+#   pip install numpy opencv-python-headless OpenEXR
+
+import os, time, struct
+import concurrent.futures
+from brenda import aws, tiling, utils
+
+EXR_EXT = ('.exr',)
+
+def need(module):
+    try:
+        return __import__(module)
+    except ImportError:
+        raise ValueError("brenda-stitch needs the Python module %r (pip install numpy opencv-python-headless OpenEXR)" % (module,))
+
+# bytes of pixels read from an EXR tile, or written to an EXR frame, at once
+CHUNK_BYTES = 16 * 1048576
+
+# numpy dtypes of the EXR pixel types, by Imath.PixelType value
+EXR_DTYPES = {0: 'uint32', 1: 'float16', 2: 'float32'}
+
+def chunk_rows(width, dtypes):
+    np = need('numpy')
+    return max(1, CHUNK_BYTES // max(1, width * sum(np.dtype(d).itemsize for d in dtypes)))
+
+def png_shape(path):
+    # (rows, columns) of a PNG from its header, or None if path isn't one
+    with open(path, 'rb') as f:
+        head = f.read(24)
+    if len(head) == 24 and head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', head[16:24])
+        return height, width
+    return None
+
+class ExrTile(object):
+    """
+    An EXR tile, read a band of scanlines at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        f = need('OpenEXR').InputFile(path)
+        try:
+            header = f.header()
+        finally:
+            f.close()
+        dw = header['dataWindow']
+        self.y0 = dw.min.y
+        self.shape = (dw.max.y - dw.min.y + 1, dw.max.x - dw.min.x + 1)
+        self.types = dict((name, c.type) for name, c in header['channels'].items())
+        self.meta = dict(compression=header.get('compression'), types=self.types)
+
+    def read(self, r0, r1, c0, c1):
+        """
+        Yield (row, channels) for bands of the rows r0..r1-1 of the
+        tile, where channels is a dict of channel name -> the array
+        of columns c0..c1-1 of the rows of the band from row on.  The
+        file is only open while its bands are read.
+        """
+        np = need('numpy')
+        dtypes = dict((name, EXR_DTYPES[t.v]) for name, t in self.types.items())
+        step = chunk_rows(self.shape[1], dtypes.values())
+        f = need('OpenEXR').InputFile(self.path)
+        try:
+            for y in range(r0, r1, step):
+                n = min(step, r1 - y)
+                yield y, dict((name, np.frombuffer(f.channel(name, self.types[name], self.y0 + y, self.y0 + y + n - 1),
+                                                   dtype=dtype).reshape(n, self.shape[1])[:, c0:c1])
+                              for name, dtype in dtypes.items())
+        finally:
+            f.close()
+
+class ImageTile(object):
+    """
+    A PNG, TIFF, etc. tile, which OpenCV can only read whole.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = {}
+        self.shape = png_shape(path)
+        if self.shape is None:
+            # read it just for its size, rather than hold it
+            # until it is placed
+            self.shape = self.image().shape[:2]
+
+    def image(self):
+        img = need('cv2').imread(self.path, need('cv2').IMREAD_UNCHANGED)
+        if img is None:
+            raise ValueError("%s: can't read image" % (self.path,))
+        return img
+
+    def read(self, r0, r1, c0, c1):
+        # as ExrTile.read, in one band
+        yield r0, {'': self.image()[r0:r1, c0:c1]}
+
+def open_tile(path):
+    if path.lower().endswith(EXR_EXT):
+        return ExrTile(path)
+    return ImageTile(path)
+
+class Frame(object):
+    """
+    A frame being stitched, held in a scratch file next to it that is
+    mapped into memory, so that the parts of the frame already placed
+    can be paged out rather than held in memory.  channels is a dict
+    of channel name -> (dtype, shape of a pixel), and meta is the meta
+    of a tile.
+    """
+
+    def __init__(self, out, width, height, channels, meta):
+        np = need('numpy')
+        self.out = out
+        self.meta = meta
+        self.scratch = out + '.stitch'
+        self.channels = {}
+        shapes = [(name, dtype, (height, width) + pixel) for name, (dtype, pixel) in sorted(channels.items())]
+        with open(self.scratch, 'wb') as f:
+            f.truncate(sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for name, dtype, shape in shapes))
+        offset = 0
+        for name, dtype, shape in shapes:
+            self.channels[name] = np.memmap(self.scratch, dtype=dtype, mode='r+', offset=offset, shape=shape)
+            offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+    def write(self):
+        tmp = self.out + '.tmp' + os.path.splitext(self.out)[1]
+        if self.out.lower().endswith(EXR_EXT):
+            OpenEXR = need('OpenEXR')
+            height, width = list(self.channels.values())[0].shape[:2]
+            header = OpenEXR.Header(width, height)
+            header['channels'] = dict((name, need('Imath').Channel(t)) for name, t in self.meta['types'].items())
+            if self.meta.get('compression') is not None:
+                header['compression'] = self.meta['compression']
+            f = OpenEXR.OutputFile(tmp, header)
+            try:
+                step = chunk_rows(width, [c.dtype for c in self.channels.values()])
+                for y in range(0, height, step):
+                    f.writePixels(dict((name, c[y:y+step].tobytes()) for name, c in self.channels.items()),
+                                  min(step, height - y))
+            finally:
+                f.close()
+        elif not need('cv2').imwrite(tmp, self.channels['']):
+            raise ValueError("%s: can't write image" % (self.out,))
+        os.rename(tmp, self.out)
+
+    def close(self):
+        self.channels = {}
+        try:
+            os.remove(self.scratch)
+        except OSError:
+            pass
+
+def tile_name(name):
+    """
+    Return (frame, tile) for the file name of a tile, where frame is
+    the file name of its frame, or None if name isn't a tile.
+    """
+    m = tiling.OUTPUT_RE.search(name)
+    if not m or m.group(2) is None:
+        return None
+    try:
+        tile = tuple(float(v) for v in m.group(2, 3, 4, 5))
+    except ValueError:
+        return None
+    return name[:m.start()] + m.group(1) + m.group(6), tile
+
+def find_tiles(paths):
+    """
+    Group tile files (or the tiles in directories) by the frame they
+    belong to.  Returns a dict of frame file name (the tile name
+    without its bounds, in the directory of the tile) -> list of
+    (tile, path), where tile is (min_x, max_x, min_y, max_y).
+    """
+    frames = {}
+    for p in paths:
+        if os.path.isdir(p):
+            files = [os.path.join(p, f) for f in sorted(os.listdir(p))]
+        else:
+            files = [p]
+        for path in files:
+            d, name = os.path.split(path)
+            t = tile_name(name)
+            if t is not None:
+                frames.setdefault(os.path.join(d, t[0]), []).append((t[1], path))
+    return frames
+
+def coverage(tiles):
+    # fraction of the frame covered by the union of tiles, which may
+    # overlap, such as the tiles of two different layouts of a frame:
+    # in each strip between consecutive X edges, merge the Y spans of
+    # the tiles across it
+    xs = sorted(set(x for t, path in tiles for x in t[0:2]))
+    covered = 0.0
+    for x0, x1 in zip(xs, xs[1:]):
+        spans = sorted((t[2], t[3]) for t, path in tiles if t[0] <= x0 and x1 <= t[1])
+        y_end = None
+        for y0, y1 in spans:
+            if y_end is None or y0 > y_end:
+                covered += (x1 - x0) * (y1 - y0)
+                y_end = y1
+            elif y1 > y_end:
+                covered += (x1 - x0) * (y1 - y_end)
+                y_end = y1
+    return covered
+
+def complete(tiles):
+    return coverage(tiles) >= 0.9999
+
+def tile_rect(tile, width, height):
+    """
+    Return the (row0, row1, col0, col1) pixel rectangle of tile in a
+    frame of the given size.  Blender's border Y axis points up, while
+    image rows go down.
+    """
+    min_x, max_x, min_y, max_y = tile
+    return (height - int(round(max_y * height)), height - int(round(min_y * height)),
+            int(round(min_x * width)), int(round(max_x * width)))
+
+def frame_size(tiles, shapes, cropped):
+    """
+    Return the (width, height) of a frame from the (rows, columns)
+    shapes of its tiles.  Tiles that aren't cropped to their border
+    all have the size of the frame.
+    """
+    if not cropped:
+        if len(set(shapes)) != 1:
+            raise ValueError("tiles differ in size, use --cropped if they are cropped to their borders")
+        return shapes[0][1], shapes[0][0]
+    ws = sorted(s[1] / (t[1] - t[0]) for (t, path), s in zip(tiles, shapes))
+    hs = sorted(s[0] / (t[3] - t[2]) for (t, path), s in zip(tiles, shapes))
+    return int(round(ws[len(ws) // 2])), int(round(hs[len(hs) // 2]))
+
+def stitch_frame(out, tiles, size=None, cropped=False):
+    """
+    Stitch tiles (a list of (tile, path)) into the frame out.  The
+    frame size is size (width, height) if given, else it's derived
+    from the tiles.  Only the headers of the tiles are read up front,
+    and each tile's file is opened again when its pixels are placed,
+    so that only one tile is open at a time.  Returns the number of
+    tiles.
+    """
+    opened = [(tile, path, open_tile(path)) for tile, path in tiles]
+    if size is None:
+        size = frame_size(tiles, [t.shape for tile, path, t in opened], cropped)
+    width, height = size
+
+    frame = None
+    try:
+        for tile, path, t in opened:
+            r0, r1, c0, c1 = tile_rect(tile, width, height)
+            if t.shape == (height, width):
+                # full-size tile
+                region = (r0, r1, c0, c1)
+                row = 0
+            elif abs(t.shape[0] - (r1 - r0)) <= 1 and abs(t.shape[1] - (c1 - c0)) <= 1:
+                # tile cropped to its border, give or take rounding
+                region = (0, min(t.shape[0], height - r0), 0, min(t.shape[1], width - c0))
+                row = r0
+            else:
+                raise ValueError("%s: %dx%d tile doesn't fit a %dx%d frame" % (
+                    path, t.shape[1], t.shape[0], width, height))
+            for y, channels in t.read(*region):
+                if frame is None:
+                    frame = Frame(out, width, height, dict((name, (c.dtype, c.shape[2:])) for name, c in channels.items()), t.meta)
+                elif sorted(channels) != sorted(frame.channels):
+                    raise ValueError("%s: channels %s don't match the other tiles %s" % (
+                        path, sorted(channels), sorted(frame.channels)))
+                for name, c in channels.items():
+                    f = frame.channels[name]
+                    if c.shape[2:] != f.shape[2:] or c.dtype != f.dtype:
+                        raise ValueError("%s: channel %r is %s %s, other tiles are %s %s" % (
+                            path, name, c.dtype, c.shape[2:], f.dtype, f.shape[2:]))
+                    f[row+y:row+y+c.shape[0], c0:c0+c.shape[1]] = c
+        frame.write()
+    finally:
+        if frame is not None:
+            frame.close()
+    return len(tiles)
+
+def _stitch_one(args):
+    out, tiles, size, cropped = args
+    start = time.time()
+    n = stitch_frame(out, tiles, size, cropped)
+    return out, n, time.time() - start
+
+def stitch(paths, out_dir=None, size=None, cropped=False, partial=False, n_procs=None):
+    """
+    Stitch the frames of the tiles in paths (files or directories),
+    in parallel on a pool of n_procs processes.  Frames go to out_dir,
+    or next to their tiles.  Frames whose tiles don't cover the whole
+    frame are skipped, unless partial is set.  Returns the number of
+    frames stitched.
+    """
+    start = time.time()
+    jobs = []
+    for out, tiles in sorted(find_tiles(paths).items()):
+        if out_dir is not None:
+            out = os.path.join(out_dir, os.path.basename(out))
+        cov = coverage(tiles)
+        if not complete(tiles) and not partial:
+            print("INCOMPLETE", out, "(%d tiles cover %.1f%% of the frame)" % (len(tiles), cov * 100.0))
+            continue
+        jobs.append((out, sorted(tiles), size, cropped))
+    if n_procs is None:
+        n_procs = os.cpu_count() or 1
+    n_tiles = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(n_procs, len(jobs) or 1))) as pool:
+        for out, n, seconds in pool.map(_stitch_one, jobs):
+            print("STITCHED %s from %d tiles in %.2f seconds" % (out, n, seconds))
+            n_tiles += n
+    elapsed = max(time.time() - start, 0.001)
+    print("STITCHED %d frames from %d tiles in %.2f seconds (%.2f frames/s)" % (
+        len(jobs), n_tiles, elapsed, len(jobs) / elapsed))
+    return len(jobs)
+
+def collect(conf, out_dir, size=None, cropped=False, n_procs=None, poll=30, once=False, keep_tiles=False):
+    """
+    Stitch frames from the subframe tiles in RENDER_OUTPUT as they
+    arrive.  Each pass lists RENDER_OUTPUT, downloads the tiles that
+    are new since the last pass to out_dir/.tiles, and starts to
+    stitch each frame whose tiles now cover it, on a pool of n_procs
+    processes.  Frames already in out_dir are taken to be stitched,
+    and their tiles are neither downloaded nor stitched again, so the
+    collector can be stopped and restarted at any time.  Passes are
+    poll seconds apart, or if once is set, there is only one pass.
+    Returns the number of frames stitched.
+    """
+    bucket, prefix = aws.get_s3_output_bucket_name(conf)
+    tile_dir = os.path.join(out_dir, '.tiles')
+    for d in (out_dir, tile_dir):
+        if not os.path.isdir(d):
+            utils.makedirs(d)
+    if n_procs is None:
+        n_procs = os.cpu_count() or 1
+    n_dl = max(1, int(conf.get('CURL_MAX_THREADS', '16')))
+
+    frames = {}        # frame -> {key: (tile, path)} for frames not yet stitched
+    fetched = set()    # keys downloaded to tile_dir
+    done = set()       # frames stitched, or that failed to stitch
+    stitching = {}     # future -> frame
+    n_frames = 0
+    start = time.time()
+
+    def fetch(key, path):
+        tmp = path + '.tmp'
+        aws.s3_get(conf, "s3://%s/%s" % (bucket, key), tmp)
+        os.rename(tmp, path)
+
+    def reap(futures):
+        n = 0
+        for f in futures:
+            frame = stitching.pop(f)
+            tiles = frames.pop(frame)
+            done.add(frame)
+            try:
+                out, n_tiles, seconds = f.result()
+            except Exception as e:
+                print("FAILED %s: %s" % (frame, e))
+                continue
+            print("STITCHED %s from %d tiles in %.2f seconds" % (out, n_tiles, seconds))
+            n += 1
+            for key, (tile, path) in tiles.items():
+                fetched.discard(key)
+                if not keep_tiles:
+                    utils.rm(path)
+        return n
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_dl) as dl_pool, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=max(1, n_procs)) as pool:
+        while True:
+            # find new tiles of frames that aren't stitched yet
+            new = []
+            for key in aws.s3_list_keys(conf, bucket, prefix):
+                t = tile_name(os.path.basename(key))
+                if t is None:
+                    continue
+                frame, tile = t
+                if frame in done:
+                    continue
+                if frame not in frames and os.path.exists(os.path.join(out_dir, frame)):
+                    done.add(frame)
+                    continue
+                tiles = frames.setdefault(frame, {})
+                if key not in tiles:
+                    path = os.path.join(tile_dir, os.path.basename(key))
+                    tiles[key] = (tile, path)
+                    if os.path.exists(path):
+                        fetched.add(key)
+                    else:
+                        new.append((frame, key, path))
+
+            # download them, then start on the frames they complete
+            downloads = dict((dl_pool.submit(fetch, key, path), (frame, key)) for frame, key, path in new)
+            for f in concurrent.futures.as_completed(downloads):
+                frame, key = downloads[f]
+                try:
+                    f.result()
+                    fetched.add(key)
+                except Exception as e:
+                    # try again next pass
+                    print("s3_get: %s: %s" % (key, e))
+                    del frames[frame][key]
+            busy = set(stitching.values())
+            for frame, tiles in sorted(frames.items()):
+                if frame not in busy and complete(list(tiles.values())) and all(k in fetched for k in tiles):
+                    out = os.path.join(out_dir, frame)
+                    stitching[pool.submit(_stitch_one, (out, sorted(tiles.values()), size, cropped))] = frame
+
+            # report the frames stitched meanwhile
+            if once:
+                n_frames += reap(list(concurrent.futures.as_completed(stitching)))
+                break
+            n_frames += reap([f for f in list(stitching) if f.done()])
+            pending = len(frames) - len(stitching)
+            print("COLLECT %d frames stitched, %d stitching, %d waiting for tiles, in %.2f seconds" % (
+                n_frames, len(stitching), pending, time.time() - start))
+            time.sleep(poll)
+
+    for frame, tiles in sorted(frames.items()):
+        print("INCOMPLETE", os.path.join(out_dir, frame), "(%d tiles cover %.1f%% of the frame)" % (
+            len(tiles), coverage(list(tiles.values())) * 100.0))
+    elapsed = max(time.time() - start, 0.001)
+    print("STITCHED %d frames in %.2f seconds (%.2f frames/s)" % (n_frames, elapsed, n_frames / elapsed))
+    return n_frames
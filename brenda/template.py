@@ -0,0 +1,127 @@
+from __future__ import print_function
+# Brenda -- Blender render tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Task templates let a job be pushed as task parameters rather than
+# as one expanded task script per message.  The task script is
+# published once per job to TASK_TEMPLATES (by default, brenda-templates/
+# next to BLENDER_PROJECT), named by its job id, the start of its
+# SHA-256 hash.  Each message is then a single line:
+#
+#   @JOBID START END STEP [SF_MIN_X SF_MAX_X SF_MIN_Y SF_MAX_Y]
+#
+# and the node expands it with the template, which it fetches once
+# and caches in its work dir.  Nodes of earlier versions would run
+# such a message as a script, which fails, so the task is retried
+# rather than lost.
+
+import os, io, hashlib
+from brenda import aws, error, utils
+
+MSG_PREFIX = '@'
+
+# subframe macros, in the order of their values in a message
+SF_MACROS = ('$SF_MIN_X', '$SF_MAX_X', '$SF_MIN_Y', '$SF_MAX_Y')
+
+# templates seen by this process, by job id
+_cache = {}
+
+def expand(script, start, end, step, macro_list=()):
+    """
+    Substitute the frame and subframe macros of a task script.
+    """
+    for key, value in (
+          ("$FRAME", "-s %d -e %d -j %d" % (start, end, step)),
+          ("$START", "%d" % (start,)),
+          ("$END", "%d" % (end,)),
+          ("$STEP", "%d" % (step,))
+          ) + tuple(macro_list):
+        script = script.replace(key, value)
+    return script
+
+def templates_url(conf):
+    url = conf.get('TASK_TEMPLATES')
+    if not url:
+        proj = conf.get('BLENDER_PROJECT', '')
+        if not proj.startswith('s3://'):
+            raise ValueError("TASK_TEMPLATES not defined in configuration, and BLENDER_PROJECT is not an s3:// URL")
+        url = proj.rsplit('/', 1)[0] + '/brenda-templates/'
+    if not url.endswith('/'):
+        url += '/'
+    return url
+
+def job_id(script):
+    return hashlib.sha256(script.encode('utf-8')).hexdigest()[:16]
+
+def publish(conf, script, dry_run=False):
+    """
+    Publish a task script as a template, and return its job id.
+    """
+    job = job_id(script)
+    url = templates_url(conf) + job
+    print("TEMPLATE", url)
+    if not dry_run:
+        bucket, key = aws.parse_s3_url(url)
+        client = aws.get_s3_client(conf)
+        error.retry(conf, lambda : client.put_object(Bucket=bucket, Key=key, Body=script.encode('utf-8'),
+                                                     ContentType='text/plain'))
+    return job
+
+def encode(job, start, end, step, macro_list=()):
+    return ' '.join([MSG_PREFIX + job, str(start), str(end), str(step)] +
+                    [value for key, value in macro_list])
+
+def is_task_msg(body):
+    return body.startswith(MSG_PREFIX)
+
+def get(conf, job, cache_dir):
+    """
+    Return the template of job, from this process, from cache_dir,
+    or else from S3.
+    """
+    script = _cache.get(job)
+    if script is not None:
+        return script
+    fn = os.path.join(cache_dir, job)
+    try:
+        with io.open(fn, encoding='utf-8', newline='') as f:
+            script = f.read()
+    except IOError:
+        url = templates_url(conf) + job
+        bucket, key = aws.parse_s3_url(url)
+        client = aws.get_s3_client(conf)
+        script = error.retry(conf, lambda : client.get_object(Bucket=bucket, Key=key)['Body'].read()).decode('utf-8')
+        print("TEMPLATE %s fetched, %d bytes" % (url, len(script)))
+        if not os.path.isdir(cache_dir):
+            utils.makedirs(cache_dir)
+        utils.write_atomic(fn, script)
+    if job_id(script) != job:
+        utils.rm(fn)
+        raise ValueError("task template %s: hash mismatch" % (job,))
+    _cache[job] = script
+    return script
+
+def task_script(conf, body, cache_dir):
+    """
+    Return the task script for an SQS message body, which is
+    either the script itself or a template message.
+    """
+    if not is_task_msg(body):
+        return body
+    f = body[len(MSG_PREFIX):].split()
+    if len(f) not in (4, 8):
+        raise ValueError("bad task template message: %r" % (body,))
+    return expand(get(conf, f[0], cache_dir), int(f[1]), int(f[2]), int(f[3]), zip(SF_MACROS, f[4:]))
@@ -0,0 +1,114 @@
+from __future__ import division
+# Brenda -- Blender render tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Subframe tiles are (min_x, max_x, min_y, max_y) tuples of fractions
+# of the frame, as in the $SF_MIN_X .. $SF_MAX_Y task script macros.
+# A cost map is a list of (min_x, max_x, min_y, max_y, seconds)
+# regions of a frame, such as the subframe tile render times of a
+# probe run, and is taken to be spread evenly over each region.
+
+import re
+
+# Render output names end with the frame number, optionally followed
+# by the subframe tile (as in the subframe task script sample), then
+# the extension, i.e. frame_000042.png or
+# frame_000042_X-0.0-0.5-Y-0.5-1.0.png
+OUTPUT_RE = re.compile(r'(\d+)(?:_X-([0-9.e-]+)-([0-9.e-]+)-Y-([0-9.e-]+)-([0-9.e-]+))?(\.[A-Za-z0-9]+)$')
+
+def tile_key(min_x, max_x, min_y, max_y):
+    return tuple(round(float(v), 6) for v in (min_x, max_x, min_y, max_y))
+
+def parse_output_name(name):
+    """
+    Return (frame, tile_key) for a render output file name, where
+    tile_key is None for whole frames, or None if name isn't one.
+    """
+    m = OUTPUT_RE.search(name)
+    if m:
+        try:
+            if m.group(2) is not None:
+                return int(m.group(1)), tile_key(*m.group(2, 3, 4, 5))
+            return int(m.group(1)), None
+        except ValueError:
+            pass
+    return None
+
+# digits that cut positions are rounded to, to keep render output
+# names short
+CUT_DIGITS = 4
+
+def grid_tiles(subdiv_x, subdiv_y):
+    # uniform subdiv_x * subdiv_y tiles, in the order of work.subframe_iterator
+    xfrac = 1.0 / subdiv_x
+    yfrac = 1.0 / subdiv_y
+    return [(x * xfrac, (x+1) * xfrac, y * yfrac, (y+1) * yfrac)
+            for x in range(subdiv_x) for y in range(subdiv_y)]
+
+def region_cost(cost_map, tile, background):
+    """
+    Return the cost of tile by cost_map, where parts of the tile
+    that the map doesn't cover cost background per unit of area.
+    """
+    x0, x1, y0, y1 = tile
+    cost = 0.0
+    covered = 0.0
+    for cx0, cx1, cy0, cy1, seconds in cost_map:
+        w = min(x1, cx1) - max(x0, cx0)
+        h = min(y1, cy1) - max(y0, cy0)
+        if w > 0 and h > 0:
+            cost += seconds * w * h / ((cx1 - cx0) * (cy1 - cy0))
+            covered += w * h
+    return cost + background * max(0.0, (x1 - x0) * (y1 - y0) - covered)
+
+def kd_tiles(cost_map, n, aspect=1.0):
+    """
+    Split the frame into n tiles of about equal cost by cost_map.
+    Each step cuts a region across its longer side in pixels, given
+    the frame's aspect ratio (width / height), at the position where
+    the costs on either side are in proportion to the number of tiles
+    each side is split into next.
+    """
+    area = sum((x1 - x0) * (y1 - y0) for x0, x1, y0, y1, seconds in cost_map)
+    background = sum(r[4] for r in cost_map) / area if area > 0 else 1.0
+
+    def split(tile, n):
+        if n == 1:
+            return [tile]
+        n_lo = n // 2
+        x0, x1, y0, y1 = tile
+        cut_x = (x1 - x0) * aspect >= (y1 - y0)
+        lo, hi = (x0, x1) if cut_x else (y0, y1)
+
+        def side(cut):
+            return (x0, cut, y0, y1) if cut_x else (x0, x1, y0, cut)
+
+        # bisect for the cut, keeping each side at least a
+        # small fraction of the region
+        want = region_cost(cost_map, tile, background) * n_lo / n
+        a, b = lo, hi
+        for i in range(40):
+            m = (a + b) / 2
+            if region_cost(cost_map, side(m), background) < want:
+                a = m
+            else:
+                b = m
+        margin = (hi - lo) / (4 * n)
+        cut = round(min(max((a + b) / 2, lo + margin), hi - margin), CUT_DIGITS)
+        upper = (cut, x1, y0, y1) if cut_x else (x0, x1, cut, y1)
+        return split(side(cut), n_lo) + split(upper, n - n_lo)
+
+    return split((0.0, 1.0, 0.0, 1.0), n)
@@ -18,17 +18,34 @@ from __future__ import print_function
 
 from future import standard_library
 standard_library.install_aliases()
-from builtins import range
 from past.utils import old_div
-import threading, time, queue
+import os, sys, time, cmd, shlex, signal, asyncio
 from brenda import aws, utils
 
-def instances(opts, conf):
+def instances(opts, conf, instance_list=None):
     now = time.time()
-    for i in aws.filter_instances(opts, conf):
+    if instance_list is None:
+        instance_list = aws.filter_instances(opts, conf)
+    for i in instance_list:
         uptime = aws.get_uptime(now, i.launch_time)
         print(i.image_id, aws.format_uptime(uptime), i.public_dns_name)
 
+def control_dir():
+    # where ssh ControlMaster sockets live, kept short, as socket
+    # paths are limited to about 100 characters
+    return os.path.join(os.path.expanduser("~"), '.ssh', 'brenda-control')
+
+def control_persist(opts, conf):
+    """
+    Return how long ssh connections to the nodes persist after their
+    last use, as an ssh ControlPersist value, or None if each command
+    makes its own connection.
+    """
+    persist = getattr(opts, 'control_persist', None) or conf.get('SSH_CONTROL_PERSIST', '600')
+    if persist in ('0', 'no'):
+        return None
+    return persist
+
 def ssh_args(opts, conf):
     user = utils.get_opt(opts.user, conf, 'AWS_USER', default='root')
     args = ['ssh', '-o', 'UserKnownHostsFile=/dev/null',
@@ -36,6 +53,17 @@ def ssh_args(opts, conf):
                    '-o', 'LogLevel=quiet']
     if user:
         args.extend(['-o', 'User='+user])
+    persist = control_persist(opts, conf)
+    if persist:
+        # share one connection per node between all ssh and rsync
+        # commands, including those of later brenda-tool runs
+        d = control_dir()
+        if not os.path.isdir(d):
+            os.makedirs(d, 0o700)
+        args.extend(['-o', 'ControlMaster=auto',
+                     '-o', 'ControlPath='+os.path.join(d, '%C'),
+                     '-o', 'ControlPersist='+persist,
+                     '-o', 'ServerAliveInterval=30'])
     args.extend(['-i', aws.get_adaptive_ssh_identity_fn(opts, conf)])
     return args
 
@@ -49,52 +77,141 @@ def ssh_cmd_list(opts, conf, args, instances=None):
         cmd.extend(args)
         yield node, cmd
 
-def rsync_cmd_list(opts, conf, args, hostset=None):
-    for i in aws.filter_instances(opts, conf, hostset=hostset):
+def rsync_cmd_list(opts, conf, args, hostset=None, instances=None):
+    if instances is None:
+        instances = aws.filter_instances(opts, conf, hostset=hostset)
+    for i in instances:
         node = i.public_dns_name
         cmd = ['rsync', '-e', ' '.join(ssh_args(opts, conf))] + [a.replace('HOST', node) for a in args]
         yield node, cmd
 
-def run_cmd_list(opts, conf, cmd_seq, show_output, capture_stderr):
-    def worker():
-        while True:
+def cmd_timeout(opts, conf, key, default):
+    # per-host timeout in seconds of a command, or None for none
+    t = float(getattr(opts, 'timeout', None) or conf.get(key, default))
+    return t if t > 0 else None
+
+def run_cmds(opts, conf, cmd_seq, capture_stderr, timeout=None):
+    """
+    Run the (node, cmd) commands of cmd_seq, up to TOOL_THREADS at a
+    time, and yield (node, output, error) for each as it finishes,
+    rather than when they all have.  error is None if the command
+    succeeded, else why it didn't.  A command that runs for more
+    than timeout seconds is killed, with what it output so far.
+    The output of a failed command is only kept if capture_stderr
+    is set.  Commands still running when the generator is closed
+    are killed.
+    """
+    max_procs = max(1, int(conf.get('TOOL_THREADS', '64')))
+
+    async def run(sem, node, cmd):
+        async with sem:
+            out = bytearray()
+            proc = None
             try:
-                item = q.get(block=False)
-            except queue.Empty as e:
-                break
-            else:
-                node, cmd = item
-                output = utils.system_return_output(cmd, capture_stderr=capture_stderr)
-                data = (node, output)
-                with lock:
-                    if show_output:
-                        print("------- %s\n%s" % data, end=' ')
-                    ret.append(data)
-                q.task_done()
+                proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.DEVNULL,
+                                                            stdout=asyncio.subprocess.PIPE,
+                                                            stderr=asyncio.subprocess.STDOUT,
+                                                            start_new_session=True)
+                async def read():
+                    while True:
+                        data = await proc.stdout.read(65536)
+                        if not data:
+                            return await proc.wait()
+                        out.extend(data)
+                status = await asyncio.wait_for(read(), timeout)
+                error = "exit status %d" % (status,) if status else None
+            except asyncio.TimeoutError:
+                error = "no answer in %g seconds" % (timeout,)
+            except OSError as e:
+                error = str(e)
+            finally:
+                if proc is not None and proc.returncode is None:
+                    # kill its children too, such as the ssh of rsync,
+                    # which would hold its output open
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    await proc.wait()
+        output = out.decode('utf-8', 'replace')
+        if error and not capture_stderr:
+            output = ""
+        return node, utils.str_nl(output), error
+
+    async def start():
+        sem = asyncio.Semaphore(max_procs)
+        return set(asyncio.ensure_future(run(sem, node, cmd)) for node, cmd in cmd_seq)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if sys.version_info < (3, 8):
+        # before 3.8, subprocesses are reaped by a child watcher
+        # that must be attached to the loop they run on
+        asyncio.get_child_watcher().attach_loop(loop)
+    pending = set()
+    try:
+        pending = loop.run_until_complete(start())
+        while pending:
+            done, pending = loop.run_until_complete(asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+            for f in done:
+                yield f.result()
+    finally:
+        for f in pending:
+            f.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.wait(pending))
+        if sys.version_info < (3, 8):
+            # let the subprocess transports finish closing while
+            # their loop is still open
+            loop.run_until_complete(asyncio.sleep(0))
+        asyncio.set_event_loop(None)
+        loop.close()
 
+def run_cmd_list(opts, conf, cmd_seq, show_output, capture_stderr, timeout=None):
+    """
+    Like run_cmds, but return the list of (node, output) of all the
+    commands, showing each output as it comes if show_output is set.
+    """
     ret = []
-    q = queue.Queue()
-    for task in cmd_seq:
-        #if opts.verbose:
-        #    print task
-        q.put(task)
-
-    lock = threading.Lock()
-    max_threads = int(conf.get('TOOL_THREADS', '64'))
-    for i in range(min(max_threads, q.qsize())):
-        t = threading.Thread(target=worker)
-        t.start()
-
-    q.join() # block until all tasks are done
+    for node, output, error in run_cmds(opts, conf, cmd_seq, capture_stderr, timeout):
+        if show_output:
+            show(node, output, error)
+        ret.append((node, output))
     return ret
 
-def ssh(opts, conf, args):
-    run_cmd_list(opts, conf, ssh_cmd_list(opts, conf, args), show_output=True, capture_stderr=True)
+def show(node, output, error):
+    print("------- %s%s\n%s" % (node, " (%s)" % (error,) if error else "", output), end=' ')
+    sys.stdout.flush()
 
-def rsync(opts, conf, args):
-    run_cmd_list(opts, conf, rsync_cmd_list(opts, conf, args), show_output=True, capture_stderr=True)
+def ssh(opts, conf, args, instances=None):
+    run_cmd_list(opts, conf, ssh_cmd_list(opts, conf, args, instances), show_output=True, capture_stderr=True,
+                 timeout=cmd_timeout(opts, conf, 'TOOL_TIMEOUT', '0'))
 
-def prune(opts, conf, args):
+def rsync(opts, conf, args, instances=None):
+    run_cmd_list(opts, conf, rsync_cmd_list(opts, conf, args, instances=instances), show_output=True, capture_stderr=True,
+                 timeout=cmd_timeout(opts, conf, 'TOOL_TIMEOUT', '0'))
+
+def query(opts, conf, script, instances):
+    """
+    Run script on the instances, with the TOOL_QUERY_TIMEOUT, and
+    yield (node, output) for those that answer, as they do.  Those
+    that don't are listed once all have answered or timed out.
+    """
+    failed = []
+    for node, output, error in run_cmds(opts, conf, ssh_cmd_list(opts, conf, script, instances), capture_stderr=False,
+                                        timeout=cmd_timeout(opts, conf, 'TOOL_QUERY_TIMEOUT', '20')):
+        if error:
+            failed.append((node, error))
+        else:
+            yield node, output
+    if failed:
+        print("No answer from %d instances" % (len(failed),))
+        for node, error in sorted(failed):
+            print("  %s (%s)" % (node, error))
+
+def control_cmd_list(opts, conf, op, instances):
+    # ssh -O op for the shared connection to each node
+    for i in instances:
+        yield i.public_dns_name, ssh_args(opts, conf) + ['-O', op, i.public_dns_name]
+
+def prune(opts, conf, args, instances=None):
     def keyfunc(i):
         v = -1
         s = i[1].strip()
@@ -126,7 +243,11 @@ def prune(opts, conf, args):
         #   if render.pid && !task_last : return SMALL
         #   if !render.pid && !task_last : return SMALL
         script = ['if', '!', '[', '-f', 'task_last', '];', 'then', 'echo', 'SMALL;', 'elif', '[', '-f', pidfile, '];', 'then', 'cat', 'task_last;', 'else', 'echo', 'BIG;', 'fi']
-        data = [(keyfunc(i), i[0]) for i in run_cmd_list(opts, conf, ssh_cmd_list(opts, conf, script), show_output=False, capture_stderr=False)]
+        if instances is None:
+            instances = aws.filter_instances(opts, conf)
+        # instances that don't answer rank as SMALL, so they are kept
+        answers = dict(query(opts, conf, script, instances))
+        data = [(keyfunc((i.public_dns_name, answers.get(i.public_dns_name, ''))), i.public_dns_name) for i in instances]
         data.sort(reverse=True)
         print("Prune ranking data")
         for d in data:
@@ -140,7 +261,7 @@ def prune(opts, conf, args):
             if not opts.dry_run:
                 aws.shutdown_by_public_dns_name(opts, conf, shutdown_list)
 
-def perf(opts, conf, args):
+def perf(opts, conf, args, instances=None):
     def task_count_last(i):
         s = i[1].split()
         try:
@@ -152,28 +273,30 @@ def perf(opts, conf, args):
             return count, last
 
     script = ['if', '[', '-f', 'task_count', ']', '&&', '[', '-f', 'task_last', '];', 'then', 'cat', 'task_count;', 'cat', 'task_last;', 'else', 'echo', '0;', 'fi']
-    instances = aws.filter_instances(opts, conf)
-    idict = dict([(i.dns_name, i) for i in instances])
+    if instances is None:
+        instances = aws.filter_instances(opts, conf)
+    idict = dict([(i.public_dns_name, i) for i in instances])
     sdict = aws.get_spot_request_dict(conf)
     data = {}
-    for i in run_cmd_list(opts, conf, ssh_cmd_list(opts, conf, script, instances), show_output=False, capture_stderr=False):
+    for i in query(opts, conf, script, instances):
         host = i[0]
         inst = idict.get(host)
         if inst:
             sir = sdict.get(inst.spot_instance_request_id)
             price = None
             if sir:
-                price = float(sir.price)
+                price = float(sir['SpotPrice'])
             tasks = task_count_last(i)
             if tasks:
                 task_count, task_last = tasks
                 uptime = aws.get_uptime(task_last, inst.launch_time) / 3600.0
-                stat = data.setdefault(inst.instance_type, dict(n=0, uptime_sum=0.0, task_sum=0, price_sum=0.0))
+                stat = data.setdefault(inst.instance_type, dict(n=0, uptime_sum=0.0, task_sum=0, price_sum=0.0, n_priced=0))
                 stat['n'] += 1
                 stat['uptime_sum'] += uptime
                 stat['task_sum'] += task_count
                 if price is not None:
                     stat['price_sum'] += price
+                    stat['n_priced'] += 1
     tph= []
     tpd = []
     total_tasks = 0.0
@@ -185,8 +308,8 @@ def perf(opts, conf, args):
         total_n += stat['n']
         tasks_per_hour = old_div(stat['task_sum'], stat['uptime_sum'])
         tph.append((tasks_per_hour, itype))
-        if 'price_sum' in stat:
-            mprice = old_div(stat['price_sum'], stat['n'])
+        if stat['price_sum'] > 0:
+            mprice = old_div(stat['price_sum'], stat['n_priced'])
             tasks_per_dollar = old_div(tasks_per_hour, mprice)
             tpd.append((tasks_per_dollar, itype))
     tph.sort(reverse=True)
@@ -198,3 +321,95 @@ def perf(opts, conf, args):
         print("Tasks per US$")
         for tasks_per_dollar, itype in tpd:
             print("  %s %.02f" % (itype, tasks_per_dollar))
+
+class Shell(cmd.Cmd):
+    """
+    Interactive brenda-tool.  The instances are looked up once (and
+    again by refresh), and an ssh connection is kept open to each of
+    them for the whole session, so that commands don't wait for an
+    ssh handshake with every instance.
+    """
+
+    intro = "brenda-tool shell: any other command line is run on all instances with ssh, see also 'help'"
+    prompt = 'brenda> '
+
+    def __init__(self, opts, conf):
+        cmd.Cmd.__init__(self)
+        self.opts = opts
+        self.conf = conf
+        self.instances = []
+        if control_persist(opts, conf):
+            # keep the connections until exit, rather than for
+            # SSH_CONTROL_PERSIST after their last use
+            opts.control_persist = 'yes'
+        self.do_refresh('')
+
+    def onecmd(self, line):
+        try:
+            return cmd.Cmd.onecmd(self, line)
+        except Exception as e:
+            print("error:", e)
+
+    def emptyline(self):
+        pass
+
+    def default(self, line):
+        self.do_ssh(line)
+
+    def do_refresh(self, arg):
+        """refresh : look up the instances again, and connect to new ones"""
+        start = time.time()
+        self.instances = aws.filter_instances(self.opts, self.conf)
+        if control_persist(self.opts, self.conf):
+            n = len(list(query(self.opts, self.conf, ['true'], self.instances)))
+            print("CONNECTED to %d of %d instances in %.2f seconds" % (n, len(self.instances), time.time() - start))
+        else:
+            print("FOUND %d instances" % (len(self.instances),))
+
+    def do_ssh(self, arg):
+        """ssh COMMAND : run COMMAND on all instances and show the output"""
+        if arg:
+            ssh(self.opts, self.conf, [arg], self.instances)
+
+    def do_rsync(self, arg):
+        """rsync ARGS : rsync file(s) to/from all instances, with HOST for the instance hostname"""
+        rsync(self.opts, self.conf, shlex.split(arg), self.instances)
+
+    def do_instances(self, arg):
+        """instances : show all instances and their uptime"""
+        instances(self.opts, self.conf, self.instances)
+
+    def do_perf(self, arg):
+        """perf : show performance/cost statistics"""
+        perf(self.opts, self.conf, shlex.split(arg), self.instances)
+
+    def do_prune(self, arg):
+        """prune N_REMAINING : kill running instances such that only N_REMAINING are retained"""
+        prune(self.opts, self.conf, shlex.split(arg), self.instances)
+        if not self.opts.dry_run:
+            self.do_refresh('')
+
+    do_s = do_ssh
+    do_r = do_rsync
+    do_i = do_instances
+
+    def do_exit(self, arg):
+        """exit : close the connections to the instances, and exit"""
+        if control_persist(self.opts, self.conf):
+            run_cmd_list(self.opts, self.conf, control_cmd_list(self.opts, self.conf, 'exit', self.instances),
+                         show_output=False, capture_stderr=False)
+        return True
+
+    def do_EOF(self, arg):
+        print()
+        return self.do_exit(arg)
+
+def shell(opts, conf, args):
+    sh = Shell(opts, conf)
+    while True:
+        try:
+            sh.cmdloop()
+            break
+        except KeyboardInterrupt:
+            print("^C")
+            sh.intro = ''
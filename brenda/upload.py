@@ -0,0 +1,162 @@
+from __future__ import division
+from __future__ import print_function
+# Brenda -- Blender render tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import os, sys, time, signal, threading, multiprocessing
+import concurrent.futures
+from brenda import aws, error
+
+class Uploader(object):
+    """
+    Uploader is the node-side handle of a long-lived worker
+    process that pushes task output files to the S3 output
+    bucket.  The worker keeps one S3 client (and its connection
+    pool) warm across tasks and pushes files in parallel on a
+    bounded pool of S3_UPLOAD_THREADS threads.
+
+    up = Uploader(conf)
+    up.push(task_id, path, s3name)   # any number of times
+    up.commit(task_id)               # no more files for task_id
+    up.abort(task_id)                # or, drop the task's files
+    ...
+    for task_id, ok, info in up.results():
+        ...
+
+    A result is returned for each committed task once all of
+    its files are pushed (ok=True, info=stats dict) or once
+    any of them has failed (ok=False, info=error text).  There
+    is no result for an aborted task.
+    """
+
+    def __init__(self, conf):
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._proc = multiprocessing.Process(target=upload_process, args=(conf, child_conn))
+        self._proc.start()
+        child_conn.close()
+
+    def push(self, task_id, path, s3name):
+        self._conn.send(('push', task_id, path, s3name))
+
+    def commit(self, task_id):
+        self._conn.send(('commit', task_id))
+
+    def abort(self, task_id):
+        self._conn.send(('abort', task_id))
+
+    def results(self):
+        ret = []
+        while self._conn.poll():
+            ret.append(self._conn.recv())
+        return ret
+
+    def waitables(self):
+        """
+        Objects for multiprocessing.connection.wait() that
+        become ready when there are results, or the worker dies.
+        """
+        return [self._conn, self._proc.sentinel]
+
+    def alive(self):
+        return self._proc.is_alive()
+
+    def stop(self):
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        if self._proc.is_alive():
+            self._proc.terminate()
+        self._proc.join()
+
+def upload_process(conf, conn):
+    def push_file(task_id, path, s3name):
+        with lock:
+            if tasks[task_id]['aborted']:
+                return 0
+        size = os.path.getsize(path)
+        print("PUSH", path, "TO", aws.format_s3_url(bucktup, s3name))
+        error.retry(conf, lambda : aws.put_s3_file(conf, bucktup, path, s3name))
+        return size
+
+    def file_done(task_id, fut):
+        with lock:
+            t = tasks[task_id]
+            t['pending'].discard(fut)
+            try:
+                t['bytes'] += fut.result()
+                t['objects'] += 1
+            except Exception as e:
+                if t['error'] is None:
+                    t['error'] = "%s" % (e,)
+            check_done(task_id)
+
+    def check_done(task_id):
+        # called with lock held
+        t = tasks[task_id]
+        if t['aborted'] and not t['pending']:
+            del tasks[task_id]
+        elif t['committed'] and not t['pending']:
+            del tasks[task_id]
+            if t['error'] is not None:
+                conn.send((task_id, False, t['error']))
+            else:
+                elapsed = max(time.time() - t['start'], 0.001)
+                mb = t['bytes'] / 1048576.0
+                print("PUSHED %d objects, %.2f MB in %.2f seconds (%.2f MB/s, %.2f objects/s)" % (
+                    t['objects'], mb, elapsed, mb / elapsed, t['objects'] / elapsed))
+                conn.send((task_id, True, dict(objects=t['objects'], bytes=t['bytes'], seconds=elapsed)))
+
+    def get_task(task_id):
+        t = tasks.get(task_id)
+        if t is None:
+            t = tasks[task_id] = dict(pending=set(), committed=False, aborted=False, error=None,
+                                      objects=0, bytes=0, start=time.time())
+        return t
+
+    # the node owns cleanup, so don't run its signal handlers here
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # reentrant, because done callbacks may run in the thread that adds them
+    tasks = {}
+    lock = threading.RLock()
+    bucktup = error.retry(conf, lambda : aws.get_s3_output_bucket(conf))
+    aws.get_s3_client(conf)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=aws.s3_upload_threads(conf))
+    try:
+        while True:
+            try:
+                req = conn.recv()
+            except EOFError:
+                break
+            with lock:
+                t = get_task(req[1])
+                if req[0] == 'push':
+                    fut = pool.submit(push_file, *req[1:])
+                    t['pending'].add(fut)
+                    fut.add_done_callback(lambda f, task_id=req[1]: file_done(task_id, f))
+                elif req[0] == 'commit':
+                    t['committed'] = True
+                    check_done(req[1])
+                elif req[0] == 'abort':
+                    # files not yet being pushed are skipped
+                    t['aborted'] = True
+                    check_done(req[1])
+    finally:
+        pool.shutdown(wait=False)
+    sys.exit(0)
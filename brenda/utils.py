@@ -16,7 +16,7 @@ from __future__ import print_function
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from builtins import object
-import os, subprocess, shutil
+import os, subprocess, shutil, struct, time, ctypes, ctypes.util
 
 def system(cmd, ignore_errors=False):
     print("***", cmd)
@@ -52,11 +52,28 @@ def shutdown():
     print("SHUTDOWN")
     system(["/sbin/shutdown", "-h", "0"])
 
-def write_atomic(path, data):
+def write_atomic(path, data, sync=False):
     tmp = path + '.tmp'
     with open(tmp, 'w') as f:
         f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
     os.rename(tmp, path)
+    if sync:
+        fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def uptime():
+    # seconds since the system booted, or None if unknown
+    try:
+        with open('/proc/uptime') as f:
+            return float(f.read().split()[0])
+    except Exception:
+        return None
 
 def str_nl(s):
     if len(s) > 0 and s[-1] != '\n':
@@ -157,3 +174,112 @@ class Cd(object):
 
     def __exit__(self, *args):
         os.chdir(self._orig)
+
+class DirWatcher(object):
+    """
+    DirWatcher watches the top level of a directory for files
+    that have been completely written.  A file is complete once
+    inotify reports that it was closed after writing or moved
+    into the directory, or, where inotify is not available, once
+    its size and mtime haven't changed for settle seconds.
+
+    watcher = DirWatcher(dir, settle)
+    for fn, path in watcher.ready():
+        ...
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+
+    def __init__(self, directory, settle=2.0):
+        self._dir = directory
+        self._settle = settle
+        self._seen = {}   # filename -> (signature, time first seen with that signature)
+        self._done = {}   # filename -> signature when returned by ready()
+        self._closed = set()
+        self._fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                if libc.inotify_add_watch(fd, directory.encode('utf-8'), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) >= 0:
+                    self._fd = fd
+                else:
+                    os.close(fd)
+        except (AttributeError, OSError):
+            pass
+
+    def fileno(self):
+        """
+        Return a file descriptor that becomes readable when
+        the directory changes, or None without inotify.
+        """
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read_events(self):
+        if self._fd is None:
+            return
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except OSError:
+                return
+            if not buf:
+                return
+            i = 0
+            while i + 16 <= len(buf):
+                wd, mask, cookie, namelen = struct.unpack_from('iIII', buf, i)
+                name = buf[i+16:i+16+namelen].rstrip(b'\0').decode('utf-8', 'replace')
+                if name:
+                    self._closed.add(name)
+                i += 16 + namelen
+
+    def ready(self, final=False):
+        """
+        Return (filename, path) for each file that is complete
+        and hasn't been returned before in its current state.
+        If final is true, all files are considered complete.
+        """
+        self._read_events()
+        now = time.time()
+        ret = []
+        for fn in sorted(os.listdir(self._dir)):
+            path = os.path.join(self._dir, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not os.path.isfile(path):
+                continue
+            sig = (st.st_size, st.st_mtime)
+            if self._done.get(fn) == sig:
+                continue
+            prev = self._seen.get(fn)
+            if prev is None or prev[0] != sig:
+                self._seen[fn] = (sig, now)
+                since = now
+            else:
+                since = prev[1]
+            if final or fn in self._closed or (self._fd is None and now - since >= self._settle):
+                self._done[fn] = sig
+                self._closed.discard(fn)
+                ret.append((fn, path))
+        return ret
+
+    def timeout(self):
+        """
+        Seconds until the directory should be checked again, or
+        None if it is enough to wait for fileno() to be readable.
+        """
+        if self._fd is not None:
+            return None
+        now = time.time()
+        pending = [since + self._settle - now for fn, (sig, since) in self._seen.items() if self._done.get(fn) != sig]
+        if pending:
+            return max(0, min(pending))
+        return self._settle
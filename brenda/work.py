@@ -17,71 +17,534 @@ from __future__ import print_function
 
 from builtins import str
 from builtins import range
-import random
-from brenda import aws
+import sys, math, time, random, array, bisect, heapq
+import concurrent.futures
+from brenda import aws, error, manifest, template, tiling
 
 def subframe_iterator_defined(opts):
     return opts.subdiv_x > 0 and opts.subdiv_y > 0
 
+def subframe_macros(subdiv_x, subdiv_y, x, y):
+    xfrac = 1.0 / subdiv_x
+    yfrac = 1.0 / subdiv_y
+    return (
+        ('$SF_MIN_X', str(x * xfrac)),
+        ('$SF_MAX_X', str((x+1) * xfrac)),
+        ('$SF_MIN_Y', str(y * yfrac)),
+        ('$SF_MAX_Y', str((y+1) * yfrac)),
+        )
+
 def subframe_iterator(opts):
     if subframe_iterator_defined(opts):
-        xfrac = 1.0 / opts.subdiv_x
-        yfrac = 1.0 / opts.subdiv_y
         for x in range(opts.subdiv_x):
-            min_x = x * xfrac
-            max_x = (x+1) * xfrac
             for y in range(opts.subdiv_y):
-                min_y = y * yfrac
-                max_y = (y+1) * yfrac
-                yield (
-                    ('$SF_MIN_X', str(min_x)),
-                    ('$SF_MAX_X', str(max_x)),
-                    ('$SF_MIN_Y', str(min_y)),
-                    ('$SF_MAX_Y', str(max_y)),
-                    )
+                yield subframe_macros(opts.subdiv_x, opts.subdiv_y, x, y)
+
+def output_index(conf):
+    """
+    List RENDER_OUTPUT once, and return the set of frames and the
+    set of (frame, tile_key) subframe tiles that are already there.
+    """
+    bucket, prefix = aws.get_s3_output_bucket_name(conf)
+    keys = aws.s3_list_keys(conf, bucket, prefix)
+    frames = set()
+    tiles = set()
+    for k in keys:
+        out = tiling.parse_output_name(k[len(prefix):])
+        if out is not None:
+            if out[1] is not None:
+                tiles.add(out)
+            else:
+                frames.add(out[0])
+    print("RENDER_OUTPUT has %d objects: %d frames and %d subframe tiles" % (len(keys), len(frames), len(tiles)))
+    return frames, tiles
+
+def n_tasks(opts):
+    if getattr(opts, 'plan', None) is not None:
+        return opts.plan.n
+    n_tiles = opts.subdiv_x * opts.subdiv_y if subframe_iterator_defined(opts) else 1
+    return len(range(opts.start, opts.end+1, opts.task_size)) * n_tiles
+
+def task_params(opts, i):
+    """
+    Return (start, end, macro_list) for task i of n_tasks(opts),
+    where tasks are numbered by frame chunk, then subframe tile.
+    """
+    if getattr(opts, 'plan', None) is not None:
+        return opts.plan.params(i)
+    macro_list = ()
+    if subframe_iterator_defined(opts):
+        i, tile = divmod(i, opts.subdiv_x * opts.subdiv_y)
+        macro_list = subframe_macros(opts.subdiv_x, opts.subdiv_y, *divmod(tile, opts.subdiv_y))
+    start = opts.start + i * opts.task_size
+    end = min(start + opts.task_size - 1, opts.end)
+    return start, end, macro_list
+
+def random_permutation(n):
+    """
+    Yield range(n) in random order using O(1) memory: a 4-round
+    Feistel network over the smallest even number of bits that
+    covers n is a random permutation of that power of two, and
+    values >= n are skipped by feeding them back in.
+    """
+    half = 1
+    while 1 << (2 * half) < n:
+        half += 1
+    mask = (1 << half) - 1
+    keys = [random.getrandbits(64) for i in range(4)]
+
+    def mix(x, k):
+        x = ((x ^ k) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        x ^= x >> 29
+        x = (x * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        return x ^ (x >> 32)
+
+    def encrypt(i):
+        l, r = i >> half, i & mask
+        for k in keys:
+            l, r = r, l ^ (mix(r, k) & mask)
+        return (l << half) | r
+
+    for i in range(n):
+        j = encrypt(i)
+        while j >= n:
+            j = encrypt(j)
+        yield j
+
+def read_profile(fn):
+    """
+    Read a cost profile: lines of FRAME SECONDS, where SECONDS may
+    be followed by the subframe tile (SF_MIN_X SF_MAX_X SF_MIN_Y
+    SF_MAX_Y), as written to task_times by brenda-node.  A frame or
+    tile that appears more than once keeps its last cost.  Lines
+    starting with # or - (such as the host lines of brenda-tool ssh)
+    are skipped, as are other lines that aren't costs (such as the
+    error of cat on a node that has no task_times yet), with a
+    warning.  Returns a dict of (frame, tile_key) -> seconds, where
+    tile_key is None for whole frames.
+    """
+    entries = {}
+    with open(fn) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0][0] in '#-':
+                continue
+            try:
+                tile = tiling.tile_key(*fields[2:6]) if len(fields) >= 6 else None
+                entries[(int(fields[0]), tile)] = float(fields[1])
+            except (ValueError, IndexError):
+                print("%s: skipping bad cost profile line: %r" % (fn, line.rstrip('\n')), file=sys.stderr)
+    if not entries:
+        raise ValueError("%s: empty cost profile" % (fn,))
+    return entries
+
+def read_costs(fn):
+    """
+    Read a per-frame cost profile (see read_profile), adding up
+    the costs of the tiles of each frame.  Returns a dict of
+    frame -> seconds.
+    """
+    costs = {}
+    for (frame, tile), seconds in read_profile(fn).items():
+        costs[frame] = costs.get(frame, 0.0) + seconds
+    return costs
+
+def read_cost_maps(fn):
+    """
+    Read the subframe tile costs of a cost profile (see
+    read_profile) as a dict of frame -> cost map (see tiling),
+    which is empty if it has none.
+    """
+    maps = {}
+    for (frame, tile), seconds in read_profile(fn).items():
+        if tile is not None:
+            maps.setdefault(frame, []).append(tile + (seconds,))
+    return maps
+
+def frame_cost_func(costs):
+    """
+    Return a function of frame number -> cost from a cost profile.
+    Frames that aren't in the profile cost as much as the nearest
+    frame that is.
+    """
+    frames = sorted(costs)
+
+    def frame_cost(frame):
+        c = costs.get(frame)
+        if c is None:
+            i = bisect.bisect_left(frames, frame)
+            near = [frames[j] for j in (i-1, i) if 0 <= j < len(frames)]
+            c = costs[min(near, key=lambda f: abs(f - frame))]
+        return c
+    return frame_cost
+
+def task_costs(opts, costs):
+    """
+    Return the predicted cost of each task of the job, by task
+    number, from a cost profile.  The subframe tiles of a frame
+    share its cost equally.
+    """
+    if getattr(opts, 'plan', None) is not None:
+        return opts.plan.task_costs()
+    frame_cost = frame_cost_func(costs)
+    n_tiles = opts.subdiv_x * opts.subdiv_y if subframe_iterator_defined(opts) else 1
+    ret = array.array('d')
+    for start in range(opts.start, opts.end+1, opts.task_size):
+        end = min(start + opts.task_size - 1, opts.end)
+        c = sum(frame_cost(f) for f in range(start, end+1)) / n_tiles
+        ret.extend([c] * n_tiles)
+    return ret
+
+def parse_aspect(aspect):
+    # frame aspect ratio given as W:H (e.g. 1920:1080) or a number
+    try:
+        w, sep, h = aspect.partition(':')
+        ratio = float(w) / float(h) if sep else float(w)
+    except (ValueError, ZeroDivisionError):
+        ratio = 0
+    if ratio <= 0:
+        raise ValueError("bad frame aspect ratio %r, should be W:H or a number > 0" % (aspect,))
+    return ratio
+
+class CostMaps(object):
+    """
+    Subframe tiling and tile costs by the cost map of the nearest
+    frame in cost_maps (see read_cost_maps), for frames of the
+    given aspect ratio (width / height).
+    """
+
+    def __init__(self, cost_maps, aspect=1.0):
+        self.maps = cost_maps
+        self.aspect = aspect
+        self.frames = sorted(cost_maps)
+        self.cache = {}
+
+    def nearest(self, frame):
+        i = bisect.bisect_left(self.frames, frame)
+        return min([self.frames[j] for j in (i-1, i) if 0 <= j < len(self.frames)], key=lambda f: abs(f - frame))
+
+    def tiles(self, frame, n):
+        # n tiles of about equal cost
+        key = (self.nearest(frame), n)
+        tiles = self.cache.get(key)
+        if tiles is None:
+            tiles = self.cache[key] = tiling.kd_tiles(self.maps[key[0]], n, self.aspect)
+        return tiles
+
+    def weights(self, frame, tiles):
+        # the share of the cost of the frame of each of tiles
+        key = (self.nearest(frame), tuple(tiles))
+        weights = self.cache.get(key)
+        if weights is None:
+            m = self.maps[key[0]]
+            costs = [tiling.region_cost(m, t, 0.0) for t in tiles]
+            total = sum(costs)
+            weights = self.cache[key] = [c / total if total > 0 else 1.0 / len(tiles) for c in costs]
+        return weights
+
+class TaskPlan(object):
+    """
+    The tasks of a job whose layout varies along the timeline: a
+    list of chunks of frames, each rendered as one task, or as one
+    task per subframe tile.  Tasks are numbered by chunk, then tile,
+    as for jobs of fixed layout.
+    """
+
+    def __init__(self, cost_maps=None):
+        self.chunks = []
+        self.first = array.array('l')  # number of the first task of each chunk
+        self.n = 0
+        self.cost_maps = cost_maps
+
+    def add(self, start, end, cost, tiles=None):
+        # cost is the predicted cost of the whole chunk, split between
+        # its tiles by cost_maps if given, else evenly
+        self.chunks.append((start, end, tiles, cost))
+        self.first.append(self.n)
+        self.n += len(tiles) if tiles else 1
+
+    def params(self, i):
+        # return (start, end, macro_list) for task i, as task_params does
+        k = bisect.bisect_right(self.first, i) - 1
+        start, end, tiles, cost = self.chunks[k]
+        macro_list = ()
+        if tiles:
+            macro_list = tuple(zip(template.SF_MACROS, [str(v) for v in tiles[i - self.first[k]]]))
+        return start, end, macro_list
+
+    def task_costs(self):
+        ret = array.array('d')
+        for start, end, tiles, cost in self.chunks:
+            if not tiles:
+                ret.append(cost)
+            elif self.cost_maps is not None:
+                ret.extend([cost * w for w in self.cost_maps.weights(start, tiles)])
+            else:
+                ret.extend([cost / len(tiles)] * len(tiles))
+        return ret
+
+    def report(self, what):
+        costs = self.task_costs()
+        grouped = [ch for ch in self.chunks if not ch[2]]
+        split = [ch for ch in self.chunks if ch[2]]
+        print("PLANNED %d tasks%s: %d tasks of %d frames, %d tasks of %d frames split into %d tiles, task cost %.0f..%.0f seconds" % (
+            self.n, what, len(grouped), sum(ch[1] - ch[0] + 1 for ch in grouped),
+            len(split), sum(ch[1] - ch[0] + 1 for ch in split), sum(len(ch[2]) for ch in split),
+            min(costs) if costs else 0, max(costs) if costs else 0))
+
+def plan_tasks(opts, costs, target, split=True, cost_maps=None, adaptive=False):
+    """
+    Size the tasks of the job so that each takes about target
+    seconds by the cost profile: runs of cheap frames are grouped
+    into one task, and, if split is set, a frame that costs
+    1.5 * target or more is split into subframe tiles, of about
+    equal cost by cost_maps if adaptive is set, else into a
+    near-square grid.
+    """
+    frame_cost = frame_cost_func(costs)
+    plan = TaskPlan(cost_maps)
+    start = None
+    acc = 0.0
+    for f in range(opts.start, opts.end+1):
+        c = frame_cost(f)
+        n = int(c / target + 0.5)
+        if split and n >= 2:
+            if start is not None:
+                plan.add(start, f-1, acc)
+                start = None
+            if adaptive:
+                tiles = cost_maps.tiles(f, n)
+            else:
+                subdiv_x = int(math.ceil(math.sqrt(n)))
+                tiles = tiling.grid_tiles(subdiv_x, int(math.ceil(float(n) / subdiv_x)))
+            plan.add(f, f, c, tiles)
+            continue
+        # end the group here if that leaves it closer to target
+        if start is not None and abs(acc + c - target) >= abs(acc - target):
+            plan.add(start, f-1, acc)
+            start = None
+        if start is None:
+            start = f
+            acc = 0.0
+        acc += c
+    if start is not None:
+        plan.add(start, opts.end, acc)
+    plan.report(" for %d seconds per task" % (target,))
+    return plan
+
+def plan_tiles(opts, costs, cost_maps, adaptive=False):
+    """
+    Lay out the job as -S, -X and -Y do, with the cost of each
+    tile by cost_maps.  If adaptive is set, each task's frames
+    are split into subdiv_x * subdiv_y tiles of about equal cost,
+    rather than a uniform grid.
+    """
+    frame_cost = frame_cost_func(costs)
+    plan = TaskPlan(cost_maps)
+    grid = tiling.grid_tiles(opts.subdiv_x, opts.subdiv_y)
+    for start in range(opts.start, opts.end+1, opts.task_size):
+        end = min(start + opts.task_size - 1, opts.end)
+        plan.add(start, end, sum(frame_cost(f) for f in range(start, end+1)),
+                 cost_maps.tiles(start, len(grid)) if adaptive else grid)
+    plan.report(" with adaptive tiles" if adaptive else " with tile costs")
+    return plan
+
+def lpt_order(costs):
+    # task numbers, longest processing time first
+    return sorted(range(len(costs)), key=costs.__getitem__, reverse=True)
+
+def task_order(opts, costs=None):
+    """
+    Return the task numbers of the job in the order to push them:
+    longest first given a cost profile, random with --randomize,
+    else sequential.
+    """
+    n = n_tasks(opts)
+    if costs is not None:
+        if opts.randomize:
+            raise ValueError("--randomize and --costs can't be used together")
+        return lpt_order(task_costs(opts, costs))
+    if opts.randomize:
+        return random_permutation(n)
+    return range(n)
+
+def load_costs(opts, task_script=None):
+    """
+    Read the cost profile given with --costs, if any, and with
+    --target-seconds, or tile costs in the profile, plan the tasks
+    of the job (as opts.plan).  With --target-seconds, subframe tiles are only
+    planned for task scripts that use the subframe macros.  Returns
+    the cost profile or None.
+    """
+    opts.plan = None
+    if not opts.costs:
+        if opts.target_seconds or opts.adaptive_tiles:
+            raise ValueError("--target-seconds and --adaptive-tiles need a cost profile, given with --costs")
+        return None
+    costs = read_costs(opts.costs)
+    cost_maps = read_cost_maps(opts.costs)
+    cost_maps = CostMaps(cost_maps, parse_aspect(opts.aspect)) if cost_maps else None
+    if opts.adaptive_tiles:
+        if cost_maps is None:
+            raise ValueError("%s: --adaptive-tiles needs subframe tile costs in the cost profile" % (opts.costs,))
+        if not opts.target_seconds and not subframe_iterator_defined(opts):
+            raise ValueError("--adaptive-tiles needs --target-seconds, or -X and -Y")
+    if opts.target_seconds:
+        if opts.target_seconds <= 0:
+            raise ValueError("--target-seconds must be > 0")
+        split = task_script is None or template.SF_MACROS[0] in task_script
+        opts.plan = plan_tasks(opts, costs, opts.target_seconds, split, cost_maps, opts.adaptive_tiles)
+    elif cost_maps is not None and subframe_iterator_defined(opts):
+        opts.plan = plan_tiles(opts, costs, cost_maps, opts.adaptive_tiles)
+    return costs
+
+def makespan(costs, n_workers):
+    """
+    Return the time it takes n_workers to work through tasks
+    of the given costs, each worker taking the next task in
+    order as soon as it is free, as nodes do with the queue.
+    """
+    free = [0.0] * n_workers
+    for c in costs:
+        heapq.heapreplace(free, free[0] + c)
+    return max(free)
+
+def gen_tasks(opts, task_script, index=None, skipped=None, job=None, costs=None):
+    """
+    Generate the task scripts for a job, without holding the
+    job in memory.  With index from output_index, tasks whose
+    output is all there already are counted in skipped[0]
+    instead.  With job, the id of the task script published as
+    a template, yield template messages instead of scripts.  With
+    costs, the cost profile, yield the most costly tasks first.
+    """
+    for i in task_order(opts, costs):
+        start, end, macro_list = task_params(opts, i)
+        if index is not None:
+            if macro_list:
+                tile = tiling.tile_key(*[value for key, value in macro_list])
+                done = all((f, tile) in index[1] for f in range(start, end+1))
+            else:
+                done = all(f in index[0] for f in range(start, end+1))
+            if done:
+                skipped[0] += 1
+                continue
+        if job is not None:
+            yield template.encode(job, start, end, 1, macro_list)
+        else:
+            yield template.expand(task_script, start, end, 1, macro_list)
 
 def push(opts, args, conf):
     # get task script
     with open(opts.task_script) as f:
         task_script = f.read()
 
-    # build tasklist
-    tasklist = []
-    for fnum in range(opts.start, opts.end+1, opts.task_size):
-        script = task_script
-        start = fnum
-        end = min(fnum + opts.task_size - 1, opts.end)
-        step = 1
-        for key, value in (
-              ("$FRAME", "-s %d -e %d -j %d" % (start, end, step)),
-              ("$START", "%d" % (start,)),
-              ("$END", "%d" % (end,)),
-              ("$STEP", "%d" % (step,))
-              ):
-            script = script.replace(key, value)
-        if subframe_iterator_defined(opts):
-            for macro_list in subframe_iterator(opts):
-                sf_script = script
-                for key, value in macro_list:
-                    sf_script = sf_script.replace(key, value)
-                tasklist.append(sf_script)
-        else:
-            tasklist.append(script)
+    # with --missing-only, find the frames that are already rendered
+    index = None
+    if opts.missing_only:
+        index = output_index(conf)
+    skipped = [0]
 
-    # possibly randomize the task list
-    if opts.randomize:
-        random.shuffle(tasklist)
+    # with --costs, push the most costly tasks first, and with
+    # --target-seconds, size the tasks by cost too
+    costs = load_costs(opts, task_script)
 
-    # get work queue
-    q = None
-    if not opts.dry_run:
-        q = aws.create_sqs_queue(conf)
+    # with --template, publish the task script once, and push
+    # only the task parameters
+    job = None
+    if opts.template:
+        job = template.publish(conf, task_script, opts.dry_run)
+
+    # tasks are generated as they are pushed, in the order
+    # requested
+    tasklist = gen_tasks(opts, task_script, index, skipped, job, costs)
 
     # push work queue to sqs
-    for task in tasklist:
-        print(task, end=' ')
-        if q is not None:
-            aws.write_sqs_queue(task, q)
+    total = n_tasks(opts) if index is None else None
+    if opts.dry_run:
+        for task in tasklist:
+            print(task, end=' ' if job is None else '\n')
+    else:
+        q = aws.create_sqs_queue(conf)
+        send_tasks(conf, q.url, tasklist, total)
+    if index is not None:
+        print("Skipped %d tasks already in RENDER_OUTPUT" % (skipped[0],))
+
+def simulate(opts, args, conf):
+    """
+    Predict the makespan of the job on opts.workers workers for
+    sequential, random and longest-first orders of its tasks,
+    from the cost profile opts.costs.
+    """
+    if not opts.costs:
+        raise ValueError("simulate needs a cost profile, given with --costs")
+    if opts.workers < 1:
+        raise ValueError("simulate needs the number of workers, given with --workers")
+    task_script = None
+    if opts.task_script:
+        with open(opts.task_script) as f:
+            task_script = f.read()
+    costs = task_costs(opts, load_costs(opts, task_script))
+    n = len(costs)
+    total = sum(costs)
+    bound = max(total / opts.workers, max(costs) if n else 0.0)
+    print("%d tasks, %.2f hours of work in total, %d workers" % (n, total / 3600.0, opts.workers))
+    print("  %-10s %10.2f hours" % ("bound", bound / 3600.0))
+    for name, order in (
+          ("sequential", range(n)),
+          ("random", random_permutation(n)),
+          ("LPT", lpt_order(costs))):
+        m = makespan((costs[i] for i in order), opts.workers)
+        print("  %-10s %10.2f hours (+%.1f%%)" % (name, m / 3600.0, max(0.0, m / bound - 1.0) * 100.0 if bound else 0.0))
+
+def send_tasks(conf, queue_url, tasks, total=None):
+    """
+    Push tasks (any iterable of task scripts) to the SQS queue
+    at queue_url in batches, with SQS_PUSH_THREADS batches in
+    flight at once, and show progress out of total tasks if
+    given.
+    """
+    n_threads = max(1, int(conf.get('SQS_PUSH_THREADS', '16')))
+    client = aws.get_sqs_client(conf, max_pool_connections=n_threads)
+    if total is None and hasattr(tasks, '__len__'):
+        total = len(tasks)
+    pushed = [0, 0]  # tasks, calls
+    start = time.time()
+    last_report = [start]
+
+    def send(batch):
+        calls = error.retry(conf, lambda : aws.send_sqs_batch(client, queue_url, batch))
+        return len(batch), calls
+
+    def report(final=False):
+        now = time.time()
+        if final or now - last_report[0] >= 1.0:
+            last_report[0] = now
+            elapsed = max(now - start, 0.001)
+            print("%s %d%s tasks in %.1f seconds (%.0f tasks/s, %d SQS calls)" % (
+                "PUSHED" if final else "pushing", pushed[0],
+                "/%d" % (total,) if total is not None and not final else "",
+                elapsed, pushed[0] / elapsed, pushed[1]))
+            sys.stdout.flush()
+
+    def collect(done):
+        for f in done:
+            n, calls = f.result()
+            pushed[0] += n
+            pushed[1] += calls
+        report()
+
+    # keep a bounded number of batches in flight, so that tasks
+    # may come from a generator without being held in memory
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as pool:
+        futures = set()
+        for batch in aws.sqs_message_batches(tasks):
+            if len(futures) >= n_threads * 4:
+                done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            futures.add(pool.submit(send, batch))
+        collect(concurrent.futures.wait(futures)[0])
+    report(final=True)
 
 def status(opts, args, conf):
     q = aws.get_sqs_queue(conf)
@@ -95,3 +558,11 @@ def reset(opts, args, conf):
             conn.delete_queue(q)
         else:
             q.purge()
+
+def publish(opts, args, conf):
+    if len(args) != 2:
+        raise ValueError("publish: project directory must be given, i.e. brenda-work publish DIR")
+    s3url = conf.get('BLENDER_PROJECT', '')
+    if not manifest.is_manifest_url(s3url):
+        raise ValueError("publish: BLENDER_PROJECT must be a manifest project, i.e. s3://BUCKET/myproject.manifest")
+    manifest.publish(conf, args[1], s3url, dry_run=opts.dry_run)
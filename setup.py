@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 # original version
 VERSION="0.5"
@@ -12,7 +12,7 @@ ext_modules = []
 setup(name = "Brenda",
       version = VERSION,
       packages = [ 'brenda' ],
-      scripts = [ 'brenda-work', 'brenda-tool', 'brenda-run', 'brenda-node', 'brenda-ebs' ],
+      scripts = [ 'brenda-work', 'brenda-tool', 'brenda-run', 'brenda-node', 'brenda-ebs', 'brenda-stitch' ],
       ext_modules = ext_modules,
 
       data_files=[('brenda/task-scripts', ['task-scripts/frame', 'task-scripts/subframe']),
@@ -21,4 +21,5 @@ setup(name = "Brenda",
       author = "James Yonan",
       author_email = "james@openvpn.net",
       description = "Blender render farm tool for Amazon Web Services",
+      python_requires = ">=3.7",
 )